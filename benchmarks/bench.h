@@ -0,0 +1,48 @@
+/* Shared by the benchmarks: the kernel is timed with the cycle and instret
+ * counters (pk lets user mode read them) and reported on one line that
+ * `install_riscv_toolchain.py bench` parses. The check value must be the
+ * same for every compiler and flag set. */
+#ifndef BENCH_H
+#define BENCH_H
+
+#include <stdio.h>
+
+#ifdef __riscv
+static inline unsigned long read_cycle(void)
+{
+    unsigned long v;
+    __asm__ volatile ("rdcycle %0" : "=r"(v));
+    return v;
+}
+
+static inline unsigned long read_instret(void)
+{
+    unsigned long v;
+    __asm__ volatile ("rdinstret %0" : "=r"(v));
+    return v;
+}
+#else
+static inline unsigned long read_cycle(void) { return 0; }
+static inline unsigned long read_instret(void) { return 0; }
+#endif
+
+#define BENCH_START() \
+    unsigned long bench_cycle = read_cycle(), bench_instret = read_instret()
+
+#define BENCH_END(check) \
+    printf("BENCH cycles=%lu instret=%lu check=%08lx\n", read_cycle() - bench_cycle, \
+           read_instret() - bench_instret, (unsigned long)(check) & 0xffffffffUL)
+
+static inline unsigned crc16(unsigned crc, unsigned data)
+{
+    int i;
+    for (i = 0; i < 16; i++) {
+        unsigned bit = (crc ^ (data >> i)) & 1;
+        crc >>= 1;
+        if (bit)
+            crc ^= 0xa001;
+    }
+    return crc & 0xffff;
+}
+
+#endif
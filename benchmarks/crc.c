@@ -0,0 +1,53 @@
+/* Bitwise and table driven CRC-32 over a buffer */
+#include "bench.h"
+
+#define SIZE 8192
+#define ITERATIONS 8
+
+static unsigned char buf[SIZE];
+static unsigned table[256];
+
+static unsigned crc32_bitwise(const unsigned char *p, int n)
+{
+    unsigned crc = 0xffffffff;
+    int i, k;
+    for (i = 0; i < n; i++) {
+        crc ^= p[i];
+        for (k = 0; k < 8; k++)
+            crc = (crc >> 1) ^ (0xedb88320 & -(crc & 1));
+    }
+    return ~crc;
+}
+
+static unsigned crc32_table(const unsigned char *p, int n)
+{
+    unsigned crc = 0xffffffff;
+    int i;
+    for (i = 0; i < n; i++)
+        crc = table[(crc ^ p[i]) & 0xff] ^ (crc >> 8);
+    return ~crc;
+}
+
+int main(void)
+{
+    unsigned check = 0;
+    int i, k, it;
+
+    for (i = 0; i < 256; i++) {
+        unsigned c = (unsigned)i;
+        for (k = 0; k < 8; k++)
+            c = (c >> 1) ^ (0xedb88320 & -(c & 1));
+        table[i] = c;
+    }
+    for (i = 0; i < SIZE; i++)
+        buf[i] = (unsigned char)(i * 7 + (i >> 3));
+
+    BENCH_START();
+    for (it = 0; it < ITERATIONS; it++) {
+        buf[it] ^= 0x5a;
+        check ^= crc32_bitwise(buf, SIZE);
+        check += crc32_table(buf, SIZE);
+    }
+    BENCH_END(check);
+    return 0;
+}
@@ -0,0 +1,55 @@
+/* Vectorizable reductions: integer dot product, maximum and a byte sum */
+#include "bench.h"
+
+#define N 4096
+#define ITERATIONS 50
+
+static int a[N], b[N];
+static unsigned char bytes[N];
+
+static int dot(int n, const int *pa, const int *pb)
+{
+    int i, sum = 0;
+    for (i = 0; i < n; i++)
+        sum += pa[i] * pb[i];
+    return sum;
+}
+
+static int max_of(int n, const int *p)
+{
+    int i, m = p[0];
+    for (i = 1; i < n; i++)
+        m = p[i] > m ? p[i] : m;
+    return m;
+}
+
+static unsigned byte_sum(int n, const unsigned char *p)
+{
+    int i;
+    unsigned sum = 0;
+    for (i = 0; i < n; i++)
+        sum += p[i];
+    return sum;
+}
+
+int main(void)
+{
+    unsigned check = 0;
+    int i, it;
+
+    for (i = 0; i < N; i++) {
+        a[i] = (i * 37) % 1021 - 510;
+        b[i] = (i * 91) % 1019 - 509;
+        bytes[i] = (unsigned char)(i * 13);
+    }
+
+    BENCH_START();
+    for (it = 0; it < ITERATIONS; it++) {
+        a[it] = it;
+        check += (unsigned)dot(N, a, b);
+        check ^= (unsigned)max_of(N, b) << (it & 7);
+        check += byte_sum(N, bytes);
+    }
+    BENCH_END(check);
+    return 0;
+}
@@ -0,0 +1,110 @@
+/* Linked list find, reverse and merge sort, after CoreMark's list kernel */
+#include "bench.h"
+
+#define NODES 256
+#define ITERATIONS 200
+
+struct node {
+    struct node *next;
+    short value;
+    short index;
+};
+
+static struct node pool[NODES];
+
+static struct node *reverse(struct node *list)
+{
+    struct node *prev = 0;
+    while (list) {
+        struct node *next = list->next;
+        list->next = prev;
+        prev = list;
+        list = next;
+    }
+    return prev;
+}
+
+static struct node *find(struct node *list, short value)
+{
+    while (list && list->value != value)
+        list = list->next;
+    return list;
+}
+
+static int less(const struct node *a, const struct node *b, int by_index)
+{
+    return by_index ? a->index < b->index : a->value < b->value;
+}
+
+static struct node *merge_sort(struct node *list, int by_index)
+{
+    int insize = 1;
+    for (;;) {
+        struct node *p = list, *tail = 0;
+        int merges = 0;
+        list = 0;
+        while (p) {
+            struct node *q = p;
+            int psize = 0, qsize = insize;
+            merges++;
+            while (psize < insize && q) {
+                psize++;
+                q = q->next;
+            }
+            while (psize > 0 || (qsize > 0 && q)) {
+                struct node *e;
+                if (0 == psize) {
+                    e = q; q = q->next; qsize--;
+                } else if (0 == qsize || !q || !less(q, p, by_index)) {
+                    e = p; p = p->next; psize--;
+                } else {
+                    e = q; q = q->next; qsize--;
+                }
+                if (tail)
+                    tail->next = e;
+                else
+                    list = e;
+                tail = e;
+            }
+            p = q;
+        }
+        tail->next = 0;
+        if (merges <= 1)
+            return list;
+        insize *= 2;
+    }
+}
+
+int main(void)
+{
+    struct node *list = 0, *n;
+    unsigned crc = 0;
+    unsigned seed = 1;
+    int i, it;
+
+    for (i = NODES - 1; i >= 0; i--) {
+        seed = seed * 1103515245 + 12345;
+        pool[i].value = (short)(seed >> 16);
+        pool[i].index = (short)i;
+        pool[i].next = list;
+        list = &pool[i];
+    }
+
+    BENCH_START();
+    for (it = 0; it < ITERATIONS; it++) {
+        n = find(list, pool[(it * 7) % NODES].value);
+        crc = crc16(crc, n ? (unsigned)n->index : 0xffff);
+        n = find(list, (short)it);
+        crc = crc16(crc, n ? (unsigned)n->index : 0xffff);
+        list = reverse(list);
+        list = merge_sort(list, 0);
+        crc = crc16(crc, (unsigned)list->value);
+        list = merge_sort(list, 1);
+        for (n = list; n; n = n->next)
+            n->value = (short)(n->value ^ it);
+    }
+    for (n = list; n; n = n->next)
+        crc = crc16(crc, (unsigned)n->value);
+    BENCH_END(crc);
+    return 0;
+}
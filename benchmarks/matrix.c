@@ -0,0 +1,89 @@
+/* Integer matrix kernels, after CoreMark's matrix kernel */
+#include "bench.h"
+
+#define N 32
+#define ITERATIONS 20
+
+static short a[N][N], b[N][N];
+static int c[N][N];
+static int v[N];
+
+static void add_const(short m[N][N], short val)
+{
+    int i, j;
+    for (i = 0; i < N; i++)
+        for (j = 0; j < N; j++)
+            m[i][j] = (short)(m[i][j] + val);
+}
+
+static void mul_vec(int out[N], short m[N][N], short x[N])
+{
+    int i, j;
+    for (i = 0; i < N; i++) {
+        int sum = 0;
+        for (j = 0; j < N; j++)
+            sum += m[i][j] * x[j];
+        out[i] = sum;
+    }
+}
+
+static void mul_mat(int out[N][N], short x[N][N], short y[N][N])
+{
+    int i, j, k;
+    for (i = 0; i < N; i++)
+        for (j = 0; j < N; j++) {
+            int sum = 0;
+            for (k = 0; k < N; k++)
+                sum += x[i][k] * y[k][j];
+            out[i][j] = sum;
+        }
+}
+
+static void mul_mat_bits(int out[N][N], short x[N][N], short y[N][N])
+{
+    int i, j, k;
+    for (i = 0; i < N; i++)
+        for (j = 0; j < N; j++) {
+            int sum = 0;
+            for (k = 0; k < N; k++) {
+                int t = x[i][k] * y[k][j];
+                sum += ((t >> 2) & 0xf) * ((t >> 5) & 0x7f);
+            }
+            out[i][j] = sum;
+        }
+}
+
+static unsigned sum_crc(unsigned crc, int *p, int n)
+{
+    int i;
+    unsigned sum = 0;
+    for (i = 0; i < n; i++)
+        sum += (unsigned)p[i];
+    return crc16(crc, sum);
+}
+
+int main(void)
+{
+    unsigned crc = 0;
+    int i, j, it;
+
+    for (i = 0; i < N; i++)
+        for (j = 0; j < N; j++) {
+            a[i][j] = (short)((i * 31 + j * 17) % 97);
+            b[i][j] = (short)((i * 13 + j * 7) % 89);
+        }
+
+    BENCH_START();
+    for (it = 0; it < ITERATIONS; it++) {
+        add_const(a, (short)(it & 3));
+        mul_vec(v, a, b[it % N]);
+        crc = sum_crc(crc, v, N);
+        mul_mat(c, a, b);
+        crc = sum_crc(crc, &c[0][0], N * N);
+        mul_mat_bits(c, a, b);
+        crc = sum_crc(crc, &c[0][0], N * N);
+        add_const(a, (short)-(it & 3));
+    }
+    BENCH_END(crc);
+    return 0;
+}
@@ -0,0 +1,47 @@
+/* Vectorizable element-wise loops: saxpy on floats holding small integers,
+ * so that the result is exact with or without fused multiply-add, and the
+ * same on integers */
+#include "bench.h"
+
+#define N 4096
+#define ITERATIONS 50
+
+static float x[N], y[N];
+static int xi[N], yi[N];
+
+static void saxpy(int n, float a, const float *restrict px, float *restrict py)
+{
+    int i;
+    for (i = 0; i < n; i++)
+        py[i] = a * px[i] + py[i];
+}
+
+static void iaxpy(int n, int a, const int *restrict px, int *restrict py)
+{
+    int i;
+    for (i = 0; i < n; i++)
+        py[i] = a * px[i] + py[i];
+}
+
+int main(void)
+{
+    unsigned check = 0;
+    int i, it;
+
+    for (i = 0; i < N; i++) {
+        x[i] = (float)(i % 17);
+        y[i] = (float)(i % 13);
+        xi[i] = i % 251;
+        yi[i] = i % 241;
+    }
+
+    BENCH_START();
+    for (it = 0; it < ITERATIONS; it++) {
+        saxpy(N, 3.0f, x, y);
+        iaxpy(N, it, xi, yi);
+    }
+    for (i = 0; i < N; i++)
+        check = check * 31 + (unsigned)y[i] + (unsigned)yi[i];
+    BENCH_END(check);
+    return 0;
+}
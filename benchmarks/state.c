@@ -0,0 +1,99 @@
+/* Number recognizing state machine over a text buffer, after CoreMark's
+ * state kernel */
+#include "bench.h"
+
+#define SIZE 4096
+#define ITERATIONS 40
+
+enum { START, INVALID, S1, S2, INT, FLOAT, EXPONENT, SCIENTIFIC, NUM_STATES };
+
+static char buf[SIZE];
+
+static int is_digit(char c)
+{
+    return c >= '0' && c <= '9';
+}
+
+static int next_state(int state, char c)
+{
+    switch (state) {
+    case START:
+        if (is_digit(c))
+            return INT;
+        if ('+' == c || '-' == c)
+            return S1;
+        if ('.' == c)
+            return FLOAT;
+        return INVALID;
+    case S1:
+        if (is_digit(c))
+            return INT;
+        if ('.' == c)
+            return FLOAT;
+        return INVALID;
+    case INT:
+        if ('.' == c)
+            return FLOAT;
+        if (!is_digit(c))
+            return INVALID;
+        return INT;
+    case FLOAT:
+        if ('E' == c || 'e' == c)
+            return S2;
+        if (!is_digit(c))
+            return INVALID;
+        return FLOAT;
+    case S2:
+        if ('+' == c || '-' == c)
+            return EXPONENT;
+        return INVALID;
+    case EXPONENT:
+        if (is_digit(c))
+            return SCIENTIFIC;
+        return INVALID;
+    case SCIENTIFIC:
+        if (!is_digit(c))
+            return INVALID;
+        return SCIENTIFIC;
+    default:
+        return INVALID;
+    }
+}
+
+int main(void)
+{
+    static const char *words[] = {"5012", "1234", "-874", "+122", "35.54", ".1234", "-110.7", "+0.64",
+                                  "5.500e+3", "-.123e-2", "-87e+832", "+0.6e-12", "T0.3e-1F", "-T.T++Tq",
+                                  "1T3.4e4z", "34.0e-T^"};
+    unsigned counts[NUM_STATES] = {0};
+    unsigned crc = 0;
+    int i, pos = 0, it;
+
+    for (i = 0; pos + 10 < SIZE; i++) {
+        const char *w = words[(i * 5) % 16];
+        while (*w)
+            buf[pos++] = *w++;
+        buf[pos++] = ',';
+    }
+    buf[pos] = 0;
+
+    BENCH_START();
+    for (it = 0; it < ITERATIONS; it++) {
+        int state = START;
+        for (i = 0; buf[i]; i++) {
+            if (',' == buf[i]) {
+                counts[state]++;
+                state = START;
+                continue;
+            }
+            state = next_state(state, buf[i]);
+        }
+        /* Corrupt and restore the buffer like CoreMark does */
+        for (i = it % 7; i < pos; i += 7)
+            buf[i] ^= 1;
+    }
+    for (i = 0; i < NUM_STATES; i++)
+        crc = crc16(crc, counts[i]);
+    BENCH_END(crc);
+    return 0;
+}
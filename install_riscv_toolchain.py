@@ -10,6 +10,7 @@ Description: This project helps automatically install
     * riscv-isa-sim (spike)
     * riscv-pk
 Prerequisites:
+    * Python 3.6+
     * Debian-like, Ubuntu
         * RISC-V utils
             * apt update
@@ -47,8 +48,11 @@ Prerequisites:
                     * [cp ninja /usr/bin] (or other path)
 Usage:
     * By default, the installation path is `./riscv_install` (`RISCV_INSTALL`) and `llvm-project/install`
+    * Each riscv-gnu-toolchain source (`TOOLCHAIN_SOURCES`) is checked out in its own git worktree under `./worktrees` (`WORKTREE_DIR`), with one build directory per target
     * [Auto] `python3 install_riscv_toolchain.py auto`
         * All repos ({linux} {linux-rvv} {elf} {elf-rvv} {llvm}) will be downloaded and built without interruption
+        * Independent stages (llvm, clone, submodules, toolchain, pk, spike) run at the same time and share NUM_CORES
+        * pk is built once per host triple and spike once per install root, both are installed into every target prefix
     * [Semi-auto] `python3 install_riscv_toolchain.py all`
         * All repos ({linux} {linux-rvv} {elf} {elf-rvv} {llvm}) will **almost** automatically except some downloading selections.
     * [Partially] `python3 install_riscv_toolchain.py {linux} {linux-rvv} {elf} {elf-rvv} {llvm}`
@@ -57,6 +61,32 @@ Usage:
         * `elf` for `riscv64-unknown-elf`
         * `elf-rvv` for `riscv64-unknown-elf` with `rvv`
         * `llvm` for LLVM clang
+        * `rv32-elf`, `rv32-elf-rvv`, `rv32-linux` for the 32-bit targets in `./riscv_install_32` (`RISCV_INSTALL_32`)
+        * All requested targets are planned together (`TARGET_MATRIX`): targets on the same riscv-gnu-toolchain source share a worktree, and pk and LLVM are built once
+    * [Multilib] `python3 install_riscv_toolchain.py --multilib auto` (or any other targets)
+        * One multilib compiler per libc for all selected arch/abi, the target prefixes get wrappers, spike and pk
+    * [Profiles] `python3 install_riscv_toolchain.py --profile=ci auto` (or `minimal`, `full` by default)
+        * `minimal` fetches and builds binutils, gcc and the libc of the targets, `ci` adds spike and pk, `full` also gdb, dejagnu and musl
+    * [Branch] `python3 install_riscv_toolchain.py --branch=<riscv-gnu-toolchain branch> elf linux`
+        * Builds the targets from that branch in their own worktrees and in `./riscv_install@<branch>`
+    * [Build service] `python3 riscv_build_service.py [config.toml|config.json]`
+        * Queues build requests from an HTTP or Unix socket API, merges identical ones and runs them in one warm work directory
+    * [Resume] `python3 install_riscv_toolchain.py --resume`
+        * Runs the last command again from `build_journal.json`, the stages that completed (clones, builds, installs) are not run again
+    * [Offline] `python3 install_riscv_toolchain.py export-bundle <dir>`, then on the node without network
+      `python3 install_riscv_toolchain.py import-bundle <dir>` and `python3 install_riscv_toolchain.py --offline auto`
+        * Depth-1 git bundles of the checked out revisions of every repo and submodule, restored as mirrors
+    * [Slim] `python3 install_riscv_toolchain.py slim [elf] [linux] ...`
+        * Strips the host binaries of the installed prefixes, hardlinks identical files across them and reports the space saved
+    * [Toolchain benchmarks] `python3 install_riscv_toolchain.py bench [gcc-O2] [clang-rvv-O3] ...`
+        * Compiles `benchmarks/` with the installed toolchains (BENCH_CONFIGS), runs it under spike and pk, report in `bench_report.json`
+    * [Build hosts] `RISCV_BUILD_HOSTS=user@host1:/build,local:/tmp/h2 python3 install_riscv_toolchain.py --yes auto`
+        * The targets are spread over the hosts, built there by this script and the installed prefixes copied back
+    * [Delta updates] `python3 install_riscv_toolchain.py make-delta <old prefix> <new prefix> <file>`, then on the nodes
+      `python3 install_riscv_toolchain.py apply-delta <file> riscv_install/elf`
+        * Only the changed files are shipped, as zstd patches against the old ones, and checked after they are applied
+    * [Benchmark] `python3 install_riscv_toolchain.py llvm-bench [default] [fast] [debug]`
+        * Builds the LLVM profiles from scratch and compares them in `llvm_benchmark.json`
     * [Manually]`python3 install_riscv_toolchain.py` then **follow the prompts**
         * Choose build target from `riscv64-linux-unknown-gnu`, `riscv64-linux-unknown-gnu` with `rvv`,`riscv64-unknown-elf`, `riscv64-unknown-elf` with `rvv`, LLVM
         * Clone riscv-gnu-toolchain, riscv-isa-sim (spike), riscv-pk or not
@@ -67,10 +97,27 @@ Example:
 
     This will automatically install `spike`, `pk`, `riscv64-unknown-elf`-toolchain and `riscv64-unknown-elf`-toolchain(with rvv) in `./riscv_install/{elf, elf-rvv}`.
 Options in the script:
-    * RISCV_INSTALL, the installation path
-    * NUM_CORES, the number of cores for your CPU
+    * RISCV_INSTALL and RISCV_INSTALL_32, the installation paths
+    * TARGET_MATRIX and TOOLCHAIN_SOURCES, the GNU targets (xlen, arch/abi, rvv, libc) and the riscv-gnu-toolchain checkouts they build from
+    * NUM_CORES, the number of cores shared by the stages running at the same time, "auto" detects usable CPUs and memory ($RISCV_NUM_CORES)
+    * LINK_JOBS, parallel LLVM link jobs, "auto" sizes them by available memory ($RISCV_LINK_JOBS)
     * *_REPO urls, in case you have unlimited github access
+    * USE_MIRROR and MIRROR_DIR ($RISCV_MIRROR_DIR), bare mirrors shared by all checkouts through alternates
+    * FETCH_POLICIES and SUBMODULE_JOBS, shallow/partial fetching per repo and parallel submodule updates
+    * MIRRORS, MIRROR_PREFIXES and STALL_TIMEOUT, candidate urls ranked by latency and a sampled throughput, stalled fetches fall back to the next
+    * USE_ARTIFACT_CACHE, ARTIFACT_DIR ($RISCV_ARTIFACT_DIR) and ARTIFACT_CACHE_GB, cache of installed prefixes keyed by sources, flags and host compiler
+    * USE_CCACHE, CCACHE_DIR ($RISCV_CCACHE_DIR) and CCACHE_MAXSIZE, ccache for host compilations with per-stage hit/miss report
+    * USE_CONFIG_CACHE and CONFIG_CACHE_DIR ($RISCV_CONFIG_CACHE_DIR), autoconf cache files shared by all configure runs, per host compiler and environment
+    * REPORT_PATH, JSON timing report (wall, cpu, peak rss, status) per stage and command with the critical path
+    * STREAM_LOGS, LOG_DIR and LOG_TAIL_LINES, stage output goes to logs/<stage>.log.gz, a progress line and the log tail of failed stages to the terminal
     * LLVM_BUILD_TOOL and LLVM_BUILD_BIN, if no ninja is installed
+    * LLVM_PROFILE ($RISCV_LLVM_PROFILE), "default", "fast" (mold/lld, distribution install) or "debug" (split DWARF)
+    * SLIM_AFTER_BUILD ($RISCV_SLIM=1) and STRIP_BINARIES, run `slim` after every build of the GNU targets
+    * SCRATCH_DIR ($RISCV_SCRATCH_DIR) and SCRATCH_GB ($RISCV_SCRATCH_GB), build directories on tmpfs within a size budget, installs stay on disk
+    * BUILD_HOSTS ($RISCV_BUILD_HOSTS), REMOTE_PYTHON and REMOTE_COSTS, ssh hosts (or "local:" directories) the targets are built on
+    * BRANCH (--branch=NAME), riscv-gnu-toolchain branch all GNU targets build from, in their own worktrees and prefixes
+    * BUILD_PROFILE ($RISCV_BUILD_PROFILE) and BUILD_PROFILES, the submodules and components of the GNU targets
+    * INCREMENTAL_BUILD, skip unchanged stages and rebuild changed sources in place (stamps in `.stamp.json`)
 ISSUES:
     * The modules failed to update in riscv-gnu-toolchain
         * Remove the whole repo and re-clone may be fast
@@ -78,17 +125,56 @@ License: GPLv3
 Copyright (c) 2022 by https://xlindo.com, All Rights Reserved.
 '''
 from multiprocessing import Pool
+import fcntl
+import gzip
+import hashlib
+import json
 import os
+import shlex
+import shutil
+import signal
+import stat
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 RISCV_INSTALL = os.getcwd() + "/riscv_install"
-NUM_CORES = "24"
+RISCV_INSTALL_32 = os.getcwd() + "/riscv_install_32"
+# "auto" sizes -j from the usable CPUs (affinity and cgroup quota) and the
+# available memory, LINK_JOBS limits the parallel LLVM links by memory
+NUM_CORES = os.getenv("RISCV_NUM_CORES", "auto")
+LINK_JOBS = os.getenv("RISCV_LINK_JOBS", "auto")
+COMPILE_JOB_MEMORY_GB = 1
+LINK_JOB_MEMORY_GB = 6
 LLVM_BUILD_TOOL = "Ninja"
 LLVM_BUILD_BIN = "ninja"
 #LLVM_BUILD_TOOL = "Unix Makefiles"
 #LLVM_BUILD_BIN = "make"
+# LLVM build profiles ($RISCV_LLVM_PROFILE):
+#   "default"  the plain Release build, system linker, everything installed
+#   "fast"     mold or lld when installed, only LLVM_DISTRIBUTION_COMPONENTS
+#              are built and installed
+#   "debug"    like "fast" with debug info split into .dwo files
+# "linkers" are tried in order, "link_memory_gb" is the memory one link
+# needs and limits the parallel link jobs
+LLVM_PROFILE = os.getenv("RISCV_LLVM_PROFILE", "default")
+LLVM_DISTRIBUTION_COMPONENTS = ["clang", "clang-resource-headers", "lld", "llvm-ar", "llvm-ranlib", "llvm-nm",
+                                "llvm-objdump", "llvm-objcopy", "llvm-readelf", "llvm-strip", "llvm-size"]
+LLVM_PROFILES = {
+    "default": {"build_type": "Release", "projects": "clang", "linkers": [], "link_memory_gb": LINK_JOB_MEMORY_GB,
+                "build_gb": 8},
+    "fast": {"build_type": "Release", "projects": "clang;lld", "linkers": ["mold", "lld"], "link_memory_gb": 2,
+             "build_gb": 8, "distribution": LLVM_DISTRIBUTION_COMPONENTS},
+    "debug": {"build_type": "RelWithDebInfo", "projects": "clang;lld", "linkers": ["mold", "lld"],
+              "link_memory_gb": 4, "build_gb": 40, "split_dwarf": True, "distribution": LLVM_DISTRIBUTION_COMPONENTS},
+}
 
 LLVM_REPO = "https://github.91chi.fun/https://github.com/llvm/llvm-project"
+LLVM_BRANCH = "release/15.x"
 
 RISCV_GNU_TOOLCHAIN_REPO = "https://github.91chi.fun/https://github.com/riscv-collab/riscv-gnu-toolchain"
 RISCV_PK_REPO = "https://github.91chi.fun/https://github.com/riscv-software-src/riscv-pk.git"
@@ -123,174 +209,2709 @@ DOT_GITMODULES = r"""[submodule "riscv-binutils"]
 	url = https://gitee.com/mirrors_community_musl-libc/musl.git
 	branch = master
 """
+DOT_GITMODULES_32 = r"""[submodule "riscv-binutils"]
+	path = riscv-binutils
+	url = https://github.91chi.fun/https://github.com/riscv-collab/riscv-binutils-gdb.git
+	branch = riscv-binutils-2.38
+[submodule "riscv-gcc"]
+	path = riscv-gcc
+	url = https://github.91chi.fun/https://github.com/riscv-collab/riscv-gcc.git
+	branch = riscv-gcc-12.1.0
+[submodule "glibc"]
+	path = glibc
+	url = https://gitee.com/mirrors_community_sourceware/glibc.git
+[submodule "riscv-dejagnu"]
+	path = riscv-dejagnu
+	url = https://github.91chi.fun/https://github.com/riscv-collab/riscv-dejagnu.git
+	branch = riscv-dejagnu-1.6
+[submodule "newlib"]
+	path = newlib
+	url = https://gitee.com/mirrors_community_sourceware/newlib-cygwin_1.git
+	branch = master
+[submodule "riscv-gdb"]
+	path = riscv-gdb
+	url = https://github.91chi.fun/https://github.com/riscv-collab/riscv-binutils-gdb.git
+	branch = fsf-gdb-10.1-with-sim
+[submodule "musl"]
+	path = musl
+	url = https://gitee.com/mirrors_community_musl-libc/musl.git
+	branch = master
+"""
 
 ENV_PATH = os.getenv("PATH")
+WORK_DIR = os.getcwd()
+# Every riscv-gnu-toolchain source (TOOLCHAIN_SOURCES) gets its own git worktree
+WORKTREE_DIR = WORK_DIR + "/worktrees"
+# Bare mirrors of all repos and submodules. Checkouts borrow their objects
+# through alternates and fetch from the mirror, so one cache can serve many
+# work directories and both install scripts.
+USE_MIRROR = True
+MIRROR_DIR = os.getenv("RISCV_MIRROR_DIR", os.path.expanduser("~/.cache/riscv_mirrors"))
+# How each repo or submodule (by directory name) is fetched:
+#   {}                            full history, through the mirror
+#   {"filter": "blob:none"}       partial clone, the mirror only keeps commits
+#                                 and trees, blobs are fetched on checkout
+#   {"depth": N, "branch": name}  shallow clone of one branch, no mirror
+FETCH_POLICIES = {
+    "llvm-project": {"depth": 1, "branch": LLVM_BRANCH},
+    "riscv-gcc": {"filter": "blob:none"},
+    "riscv-binutils": {"filter": "blob:none"},
+    "riscv-gdb": {"filter": "blob:none"},
+    "glibc": {"filter": "blob:none"},
+    "newlib": {"filter": "blob:none"},
+}
+# Number of submodules fetched at the same time
+SUBMODULE_JOBS = 8
+# Other places to fetch a repo or submodule url from. The latency of the
+# candidates is probed at the same time (git ls-remote), then their throughput
+# one after the other with a shallow clone stopped after PROBE_SAMPLE_SECONDS
+# or PROBE_SAMPLE_MB. They are tried from the one that would fetch
+# PROBE_RANK_MB the fastest on. A fetch that neither grows its repository nor
+# uses CPU (e.g. resolving deltas) for STALL_TIMEOUT seconds is killed and
+# continues from the next candidate. file:// urls work as well.
+MIRRORS = {
+    "https://gitee.com/mirrors_community_sourceware/git_binutils-gdb.git": ["https://sourceware.org/git/binutils-gdb.git"],
+    "https://gitee.com/mirrors_community_sourceware/glibc.git": ["https://sourceware.org/git/glibc.git"],
+    "https://gitee.com/mirrors_community_sourceware/newlib-cygwin_1.git": ["https://sourceware.org/git/newlib-cygwin.git"],
+    "https://gitee.com/mirrors_community_musl-libc/musl.git": ["https://git.musl-libc.org/git/musl"],
+}
+# Every url starting with a key also gets the candidates made by replacing
+# the key with each value, e.g. the GitHub proxy falls back to GitHub
+MIRROR_PREFIXES = {
+    "https://github.91chi.fun/https://github.com/": ["https://github.com/"],
+}
+PROBE_TIMEOUT = 20
+PROBE_SAMPLE_SECONDS = 5
+PROBE_SAMPLE_MB = 4
+PROBE_RANK_MB = 100
+# Only fetch from the mirrors in MIRROR_DIR, e.g. after import-bundle on a
+# node without network ($RISCV_OFFLINE=1 or --offline)
+OFFLINE = "1" == os.getenv("RISCV_OFFLINE", "0")
+BUNDLE_MANIFEST = "manifest.json"
+# `make-delta` packs the difference between two installed prefixes (zstd
+# --patch-from for changed files, nothing for files that were only moved),
+# `apply-delta` turns the old prefix into the new one and checks the result
+DELTA_MANIFEST = "delta.json"
+STALL_TIMEOUT = 120
+STALL_POLL = 10
+STALL_CPU = 1
+# Installed prefixes are packed into ARTIFACT_DIR under a hash of their
+# sources, configure commands and host compiler, and restored from there
+# instead of being rebuilt. The least recently used archives are removed
+# once the cache grows over ARTIFACT_CACHE_GB.
+USE_ARTIFACT_CACHE = True
+ARTIFACT_DIR = os.getenv("RISCV_ARTIFACT_DIR", os.path.expanduser("~/.cache/riscv_artifacts"))
+ARTIFACT_CACHE_GB = 50
+# Host compilations of the toolchain, spike and LLVM go through ccache, the
+# hits and misses of each stage are reported at the end of the run
+USE_CCACHE = shutil.which("ccache") is not None
+CCACHE_DIR = os.getenv("RISCV_CCACHE_DIR", os.path.expanduser("~/.cache/riscv_ccache"))
+CCACHE_MAXSIZE = "20G"
+CCACHE_STATS_DIR = WORK_DIR + "/ccache_stats"
+# Autoconf cache files shared by every configure run of riscv-gnu-toolchain
+# (with its sub-configures), pk and spike, across targets and runs. A
+# CONFIG_SITE script picks one cache file per configure script, arguments
+# and environment (minus CONFIG_CACHE_VOLATILE_ENV), in a directory keyed by
+# the host compiler and STAMP_ENV_VARS. Directories unused for
+# CONFIG_CACHE_DAYS are removed.
+USE_CONFIG_CACHE = True
+CONFIG_CACHE_DIR = os.getenv("RISCV_CONFIG_CACHE_DIR", os.path.expanduser("~/.cache/riscv_config_cache"))
+CONFIG_CACHE_DAYS = 30
+CONFIG_CACHE_VOLATILE_ENV = ["PWD", "OLDPWD", "SHLVL", "_", "MAKEFLAGS", "MFLAGS", "MAKELEVEL", "MAKEOVERRIDES",
+                             "GNUMAKEFLAGS", "MAKE_TERMOUT", "MAKE_TERMERR", "CCACHE_STATSLOG", "TERM", "COLUMNS",
+                             "LINES", "DISPLAY", "WINDOWID", "SSH_[A-Z_]*", "XDG_[A-Z_]*"]
+CONFIG_SITE_SCRIPT = r"""# Written by install_riscv_toolchain.py
+if test -n "%(site)s"; then . "%(site)s"; fi
+case $cache_file in
+/dev/null|./config.cache)
+  # Every target has its own prefix (in --prefix, --with-sysroot, PATH, ...),
+  # it and the directory options are left out so the targets share the cache
+  riscv_prefix=`expr "X$ac_configure_args" : "X.*'--prefix=\\([^']*\\)'"`
+  riscv_cache_key=`{ cksum < "$0"; echo "$ac_configure_args|$build_alias|$host_alias|$target_alias"
+    env | grep -v -E '^(%(volatile)s)=' | sort; } |
+    sed -e "s|'--[a-z-]*dir=[^']*'||g" -e "s|'--\\(exec-prefix\\|prefix\\|cache-file\\)=[^']*'||g" \\
+      ${riscv_prefix:+-e "s|$riscv_prefix|@prefix@|g"} | cksum | cut -d' ' -f1`
+  cache_file="%(dir)s/$riscv_cache_key.cache"
+  ;;
+esac
+"""
+# `slim` shrinks the installed prefixes: strips the host binaries (with
+# STRIP_BINARIES), hardlinks identical files across all prefixes, checks that
+# every toolchain still compiles and prints the space saved. SLIM_AFTER_BUILD
+# ($RISCV_SLIM=1) runs it after the GNU targets are built.
+SLIM_AFTER_BUILD = "1" == os.getenv("RISCV_SLIM", "0")
+STRIP_BINARIES = True
+# Wall time, CPU time, peak RSS and exit status of every stage and command
+# of a run, with the critical path and the parallel efficiency
+REPORT_PATH = WORK_DIR + "/build_report.json"
+# The output of the commands of a stage goes to LOG_DIR/<stage>.log.gz
+# instead of the terminal, which shows one progress line for the running
+# stages (a plain line every PROGRESS_INTERVAL_PLAIN seconds when it is not a
+# terminal). When a stage fails, the last LOG_TAIL_LINES lines of its log are
+# printed.
+STREAM_LOGS = True
+LOG_DIR = WORK_DIR + "/logs"
+LOG_TAIL_LINES = 40
+PROGRESS_INTERVAL = 1
+PROGRESS_INTERVAL_PLAIN = 60
+# Status of every stage of the last run, `--resume` skips the stages that
+# completed and runs the failed and unfinished ones again
+JOURNAL_PATH = WORK_DIR + "/build_journal.json"
+RESUME = False
+# Hosts the targets are built on instead of here ($RISCV_BUILD_HOSTS, comma
+# separated). "[user@]host:/dir" runs over ssh in /dir, "local:/dir" runs the
+# same commands in a local directory and stands in for a host. The targets
+# are spread over the hosts by REMOTE_COSTS and core count, each host runs
+# this script for its targets and the installed prefixes are copied back.
+BUILD_HOSTS = [h for h in os.getenv("RISCV_BUILD_HOSTS", "").split(",") if h]
+REMOTE_PYTHON = "python3"
+REMOTE_COSTS = {"llvm": 4, "glibc": 3, "newlib": 2}
+# Settings passed on to the build hosts when they are set here
+REMOTE_ENV = ["RISCV_LLVM_PROFILE", "RISCV_OFFLINE", "RISCV_MULTILIB", "RISCV_BUILD_PROFILE"]
+# Answer yes to the clone questions (--yes)
+ASSUME_YES = False
+# Written by `llvm-bench`, the LLVM profiles built side by side
+LLVM_BENCHMARK_PATH = WORK_DIR + "/llvm_benchmark.json"
+# `bench` compiles the programs in BENCH_DIR with every configuration: the
+# target whose compiler (gcc or the LLVM clang with its sysroot), spike and
+# pk are used, and the flags. Results go to BENCH_REPORT_PATH, instret
+# changes against the previous report above BENCH_THRESHOLD are flagged.
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+BENCH_BUILD_DIR = WORK_DIR + "/bench_build"
+BENCH_REPORT_PATH = WORK_DIR + "/bench_report.json"
+BENCH_THRESHOLD = 0.02
+BENCH_TIMEOUT = 600
+BENCH_CONFIGS = {
+    "gcc-O2": {"target": "elf", "cc": "gcc", "cflags": "-O2"},
+    "gcc-O3": {"target": "elf", "cc": "gcc", "cflags": "-O3"},
+    "gcc-rvv-O3": {"target": "elf-rvv", "cc": "gcc", "cflags": "-O3"},
+    "clang-O2": {"target": "elf", "cc": "clang", "cflags": "-O2"},
+    "clang-O3": {"target": "elf", "cc": "clang", "cflags": "-O3"},
+    "clang-rvv-O3": {"target": "elf-rvv", "cc": "clang",
+                     "cflags": "-O3 -march=rv64gcv -mllvm -riscv-v-vector-bits-min=128"},
+    "rv32-gcc-O2": {"target": "rv32-elf", "cc": "gcc", "cflags": "-O2"},
+}
+
+# riscv-gnu-toolchain checkouts: branch, .gitmodules written over the
+# checked out one (None keeps it) and riscv-gcc branch. Targets using the same
+# source share one worktree.
+TOOLCHAIN_SOURCES = {
+    "master": {"branch": "master", "gitmodules": None, "gcc": "riscv-gcc-12.1.0"},
+    "rvv-next": {"branch": "rvv-next", "gitmodules": DOT_GITMODULES, "gcc": "riscv-gcc-rvv-next"},
+    "rv32": {"branch": "master", "gitmodules": DOT_GITMODULES_32, "gcc": "riscv-gcc-12.1.0"},
+    "rv32-rvv": {"branch": "master", "gitmodules": DOT_GITMODULES_32, "gcc": "riscv-gcc-rvv-next"},
+}
+# riscv-gnu-toolchain branch every GNU target is built from instead of its
+# source's one (--branch=NAME), empty keeps TOOLCHAIN_SOURCES, see use_branch
+BRANCH = ""
+# The GNU target matrix, xlen x arch/abi x rvv x libc. A run plans all the
+# requested targets together, so sources, pk, spike and LLVM are only built
+# once however many targets use them.
+TARGET_MATRIX = {
+    "elf": {"xlen": 64, "libc": "newlib", "source": "master", "prefix": RISCV_INSTALL + "/elf"},
+    "elf-rvv": {"xlen": 64, "libc": "newlib", "source": "rvv-next", "arch": "rv64gcv", "abi": "lp64d",
+                "prefix": RISCV_INSTALL + "/elf-rvv"},
+    "linux": {"xlen": 64, "libc": "glibc", "source": "master", "prefix": RISCV_INSTALL + "/linux"},
+    "linux-rvv": {"xlen": 64, "libc": "glibc", "source": "rvv-next", "arch": "rv64gcv", "abi": "lp64d",
+                  "prefix": RISCV_INSTALL + "/linux-rvv"},
+    "rv32-elf": {"xlen": 32, "libc": "newlib", "source": "rv32", "arch": "rv32gc", "abi": "ilp32d",
+                 "prefix": RISCV_INSTALL_32 + "/elf"},
+    "rv32-elf-rvv": {"xlen": 32, "libc": "newlib", "source": "rv32-rvv", "arch": "rv32gcv", "abi": "ilp32d",
+                     "prefix": RISCV_INSTALL_32 + "/elf-rvv"},
+    "rv32-linux": {"xlen": 32, "libc": "glibc", "source": "rv32", "arch": "rv32gc", "abi": "ilp32d",
+                   "prefix": RISCV_INSTALL_32 + "/linux"},
+}
+# Build one multilib compiler per libc for all selected GNU targets instead
+# of one compiler per target ($RISCV_MULTILIB=1 or --multilib). With newlib
+# the arch/abi of every target is one multilib, with glibc gcc only has its
+# default linux multilibs (rv32imac/ilp32, rv32gc/ilp32d, rv64imac/lp64,
+# rv64gc/lp64d) and the vector targets use the scalar ones. The prefix of
+# each target gets wrappers calling the shared compiler with its
+# -march/-mabi, and its own spike and pk.
+MULTILIB = "1" == os.getenv("RISCV_MULTILIB", "0")
+MULTILIB_DRIVERS = ["gcc", "g++", "c++", "cpp"]
+GNU_TARGETS = [tg for tg in TARGET_MATRIX if 64 == TARGET_MATRIX[tg]["xlen"]]
+RV32_TARGETS = [tg for tg in TARGET_MATRIX if 32 == TARGET_MATRIX[tg]["xlen"]]
+# What the GNU targets fetch and build ($RISCV_BUILD_PROFILE or --profile=NAME):
+#   "minimal"  binutils, gcc and the C libraries of the selected targets
+#   "ci"       like "minimal", with spike and pk for smoke tests
+#   "full"     every submodule but qemu (gdb with sim, dejagnu, musl), gdb,
+#              spike and pk
+# "submodules" are the riscv-gnu-toolchain submodules checked out besides the
+# libc ones of the targets, None is all of them
+BUILD_PROFILE = os.getenv("RISCV_BUILD_PROFILE", "full")
+BUILD_PROFILES = {
+    "minimal": {"submodules": ["riscv-binutils", "riscv-gcc"], "gdb": False, "spike": False},
+    "ci": {"submodules": ["riscv-binutils", "riscv-gcc"], "gdb": False, "spike": True},
+    "full": {"submodules": None, "gdb": True, "spike": True},
+}
+
+# Skip stages whose sources and configuration did not change since the last
+# successful build, and rebuild in place when only the sources changed
+INCREMENTAL_BUILD = True
+STAMP_NAME = ".stamp.json"
+STAMP_ENV_VARS = ["PATH", "CC", "CXX", "CFLAGS", "CXXFLAGS", "CPPFLAGS", "LDFLAGS", "LD_LIBRARY_PATH"]
+# riscv-gnu-toolchain stamps/ entries to drop when a submodule changed, make
+# rebuilds everything depending on them
+TOOLCHAIN_COMPONENT_STAMPS = {"riscv-binutils": "build-binutils", "riscv-gcc": "build-gcc",
+                              "newlib": "build-newlib", "glibc": "build-glibc",
+                              "riscv-gdb": "build-gdb", "musl": "build-musl"}
+# Build directories on tmpfs or another scratch path ($RISCV_SCRATCH_DIR, e.g.
+# /dev/shm/riscv_build), empty keeps them in the source trees. A build goes
+# there while the estimated sizes of the builds on it fit in SCRATCH_GB
+# ($RISCV_SCRATCH_GB, "auto" is half the available memory, at most the free
+# space), otherwise it builds on disk. Installs always go to the prefixes on
+# disk, and a scratch build directory is freed once it is not needed anymore.
+SCRATCH_DIR = os.getenv("RISCV_SCRATCH_DIR", "")
+SCRATCH_GB = os.getenv("RISCV_SCRATCH_GB", "auto")
+# Estimated size of a build directory, LLVM's is build_gb of its profile
+BUILD_FOOTPRINT_GB = {"newlib": 6, "glibc": 14, "spike": 1, "pk": 1}
+
+# Relative share of NUM_CORES given to a stage when several stages run at once.
+# Stages with weight 0 are I/O bound (clone, checkout) and always get one job.
+STAGE_WEIGHTS = {"clone": 0, "prefix": 0, "submodules": 0, "worktree": 0, "source": 0, "cache": 0,
+                 "install": 0, "remote": 0, "pack": 1, "bench": 1, "slim": 1, "toolchain": 4, "pk": 1, "spike": 2, "llvm": 4}
+
+
+STEP_RECORDS = []
+STAGE_LOGS = {}
+STAGE_LOGS_LOCK = threading.Lock()
+STAGE_CONTEXT = threading.local()
+
+
+def cgroup_file(controller, name):
+    # Path of a cgroup v2 (controller None) or v1 control file of this process
+    paths = {}
+    try:
+        with open("/proc/self/cgroup") as f:
+            for line in f:
+                _, controllers, path = line.strip().split(":", 2)
+                for c in controllers.split(","):
+                    paths[c] = path.strip("/")
+    except OSError:
+        return None
+    if controller:
+        roots = [os.path.join("/sys/fs/cgroup", d) for d in [controller, "cpu,cpuacct"]]
+        path = paths.get(controller, "")
+    else:
+        roots = ["/sys/fs/cgroup", "/sys/fs/cgroup/unified"]
+        path = paths.get("", "")
+    for root in roots:
+        for d in [os.path.join(root, path), root]:
+            if os.path.exists(os.path.join(d, name)):
+                return os.path.join(d, name)
+    return None
+
+
+def read_numbers(path):
+    try:
+        with open(path) as f:
+            return [int(v) for v in f.read().split()]
+    except (TypeError, OSError, ValueError):
+        return None
+
+
+def usable_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = read_numbers(cgroup_file(None, "cpu.max"))
+    if not quota:
+        quota = (read_numbers(cgroup_file("cpu", "cpu.cfs_quota_us")) or []) + \
+            (read_numbers(cgroup_file("cpu", "cpu.cfs_period_us")) or [])
+    if quota and 2 == len(quota) and quota[0] > 0 and quota[1] > 0:
+        cpus = min(cpus, max(1, (quota[0] + quota[1] // 2) // quota[1]))
+    return cpus
+
+
+def available_memory():
+    # Bytes this process can still use, the smaller of the host and the cgroup
+    avail = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    avail = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    for limit, usage in [(cgroup_file(None, "memory.max"), cgroup_file(None, "memory.current")),
+                         (cgroup_file("memory", "memory.limit_in_bytes"), cgroup_file("memory", "memory.usage_in_bytes"))]:
+        limit, usage = read_numbers(limit), read_numbers(usage)
+        if limit and usage and limit[0] < 1 << 60:
+            avail = min(avail or limit[0], limit[0] - usage[0])
+    return avail or 0
+
+
+def compile_jobs():
+    if "auto" != NUM_CORES:
+        return int(NUM_CORES)
+    jobs = usable_cpus()
+    mem = available_memory()
+    if mem:
+        jobs = min(jobs, max(1, mem // (COMPILE_JOB_MEMORY_GB << 30)))
+    return jobs
+
+
+def link_jobs(memory_gb=LINK_JOB_MEMORY_GB):
+    if "auto" != LINK_JOBS:
+        return int(LINK_JOBS)
+    mem = available_memory()
+    return max(1, min(compile_jobs(), mem // (memory_gb << 30))) if mem else 1
+
+
+class StageLog:
+    def __init__(self, stage):
+        os.makedirs(LOG_DIR, exist_ok=True)
+        self.path = os.path.join(LOG_DIR, stage + ".log.gz")
+        self.file = gzip.open(self.path, "wt")
+        self.lock = threading.Lock()
+        self.lines = 0
+        self.tail = deque(maxlen=LOG_TAIL_LINES)
+
+    def write(self, line):
+        with self.lock:
+            self.file.write(line)
+            self.lines += 1
+            self.tail.append(line)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def stage_log(stage):
+    with STAGE_LOGS_LOCK:
+        if stage not in STAGE_LOGS:
+            STAGE_LOGS[stage] = StageLog(stage)
+        return STAGE_LOGS[stage]
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                # Temporary files come and go while git is fetching
+                continue
+            total += st.st_size
+    return total
+
+
+def group_cpu_time(pgid):
+    # CPU seconds of the processes in group pgid and of the children they
+    # waited for, 0 without /proc
+    ticks = 0
+    for pid in os.listdir("/proc") if os.path.isdir("/proc") else []:
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/" + pid + "/stat") as f:
+                # The fields after the command name, which may contain spaces
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if int(fields[2]) == pgid:
+            ticks += sum(int(x) for x in fields[11:15])
+    return ticks / float(os.sysconf("SC_CLK_TCK"))
+
+
+def watch_stall(proc, paths, timeout, done, stalled):
+    # Kill proc and its children once paths stop growing and they use less
+    # than STALL_CPU seconds of CPU for timeout seconds. index-pack resolving
+    # deltas does not write to paths for a long time, but keeps a CPU busy.
+    size, cpu, last = -1, 0, time.time()
+    while not done.wait(STALL_POLL):
+        current = sum(dir_size(p) for p in paths)
+        current_cpu = group_cpu_time(proc.pid)
+        if current != size or current_cpu - cpu >= STALL_CPU or current_cpu < cpu:
+            size, cpu, last = current, current_cpu, time.time()
+        elif time.time() - last > timeout:
+            stalled.append(paths)
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                # Exited in the meantime
+                pass
+            return
+
+
+def run(cmd, cwd=None, env=None, stall=None):
+    # Inside a stage the output is streamed into the stage log, outside of
+    # one it goes to the terminal. stall is ([paths], seconds), the command
+    # is killed when the paths do not grow for that long.
+    stage = getattr(STAGE_CONTEXT, "name", None)
+    log = stage_log(stage) if STREAM_LOGS and stage else None
+    line = "[" + (cwd or WORK_DIR) + "] " + cmd
+    if log:
+        log.write(line + "\n")
+    else:
+        print(line)
+    start = time.time()
+    out = subprocess.PIPE if log else None
+    proc = subprocess.Popen(cmd, shell=True, cwd=cwd, env=env, stdout=out,
+                            stderr=subprocess.STDOUT if log else None, start_new_session=bool(stall))
+    done, stalled = threading.Event(), []
+    if stall:
+        threading.Thread(target=watch_stall, args=(proc, stall[0], stall[1], done, stalled), daemon=True).start()
+    if log:
+        for text in proc.stdout:
+            log.write(text.decode(errors="replace"))
+        proc.stdout.close()
+    # wait4 also accounts the descendants the shell waited for
+    _, status, usage = os.wait4(proc.pid, 0)
+    done.set()
+    # Like subprocess, -N when killed by signal N (Python 3.6 has no
+    # os.waitstatus_to_exitcode)
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if stalled:
+        print("[" + (cwd or WORK_DIR) + "] stalled for " + str(stall[1]) + "s, killed: " + cmd)
+    STEP_RECORDS.append({"stage": getattr(STAGE_CONTEXT, "name", None), "cmd": cmd, "cwd": cwd or WORK_DIR,
+                         "start": start, "wall": time.time() - start, "cpu": usage.ru_utime + usage.ru_stime,
+                         "max_rss_kb": usage.ru_maxrss, "status": proc.returncode})
+    return 0 == proc.returncode
+
+
+def run_all(cmds, cwd=None, env=None):
+    for cmd in cmds:
+        if not run(cmd, cwd, env):
+            return False
+    return True
+
+
+class Stage:
+    def __init__(self, name, action, deps=(), locks=(), kind=None):
+        self.name = name
+        self.action = action
+        self.deps = list(deps)
+        self.locks = list(locks)
+        self.weight = STAGE_WEIGHTS.get(kind or name.split("-")[0], 1)
+        self.status = "pending"
+        self.jobs = 1
+        self.start = None
+        self.end = None
+
+
+def run_stages(stages, num_cores=None, max_parallel=None):
+    # Start every stage whose dependencies are done and whose locks are free,
+    # splitting num_cores between the running stages by weight.
+    num_cores = int(num_cores or compile_jobs())
+    by_name = {st.name: st for st in stages}
+    for st in stages:
+        for dep in st.deps:
+            if dep not in by_name:
+                raise ValueError("Stage " + st.name + " depends on unknown stage " + dep)
+
+    cond = threading.Condition()
+    running = []
+    started = time.time()
+    del STEP_RECORDS[:]
+    STAGE_LOGS.clear()
+    journal = start_journal(stages)
+    print("Building with %d cores (%d usable CPUs, %.1f GB available memory)" % (
+        num_cores, usable_cpus(), available_memory() / float(1 << 30)))
+    if STREAM_LOGS:
+        print("Stage logs are written to " + LOG_DIR)
+    progress = threading.Event()
+    console = sys.stdout
+    if STREAM_LOGS and sys.stdout.isatty():
+        console = sys.stdout = StatusConsole(sys.stdout)
+    if STREAM_LOGS:
+        threading.Thread(target=show_progress, args=(running, cond, progress, started, console), daemon=True).start()
+
+    def worker(st):
+        STAGE_CONTEXT.name = st.name
+        st.start = time.time()
+        try:
+            ok = st.action(st.jobs)
+        except Exception as e:
+            print("Stage " + st.name + " raised " + repr(e))
+            ok = False
+        log = STAGE_LOGS.get(st.name)
+        if log:
+            log.close()
+        with cond:
+            st.end = time.time()
+            st.status = "done" if ok else "failed"
+            running.remove(st)
+            print("[" + st.name + "] " + st.status)
+            if not ok and log:
+                print_log_tail(st.name, log)
+            journal["stages"][st.name] = st.status
+            write_journal(journal)
+            cond.notify()
+
+    with cond:
+        while True:
+            changed = True
+            while changed:
+                changed = False
+                for st in stages:
+                    if "pending" == st.status and any(by_name[d].status in ["failed", "skipped"] for d in st.deps):
+                        st.status = "skipped"
+                        changed = True
+                        print("[" + st.name + "] skipped")
+                        journal["stages"][st.name] = st.status
+
+            held = set(lk for st in running for lk in st.locks)
+            starting = []
+            for st in stages:
+                if max_parallel and len(running) + len(starting) >= max_parallel:
+                    break
+                if "pending" != st.status or held.intersection(st.locks):
+                    continue
+                if all("done" == by_name[d].status for d in st.deps):
+                    starting.append(st)
+                    held.update(st.locks)
+
+            load = sum(st.weight for st in running + starting)
+            for st in starting:
+                st.jobs = max(1, num_cores * st.weight // load) if st.weight else 1
+                st.status = "running"
+                running.append(st)
+                print("[" + st.name + "] started with -j" + str(st.jobs))
+                threading.Thread(target=worker, args=(st,), daemon=True).start()
+
+            if not running:
+                break
+            cond.wait()
+
+    progress.set()
+    if isinstance(console, StatusConsole):
+        console.set_status("")
+        sys.stdout = console.out
+    for st in stages:
+        if "pending" == st.status:
+            st.status = "skipped"
+    release_finished_scratch()
+    if USE_CCACHE:
+        print_ccache_report([st.name for st in stages])
+    write_report(stages, num_cores, started)
+    failed = [st.name for st in stages if "done" != st.status]
+    if failed:
+        print("Stages not completed: " + ", ".join(failed))
+    return not failed
+
+
+class StatusConsole:
+    # stdout of a terminal with a status line below the printed lines, the
+    # line is cleared before anything else is written
+    def __init__(self, out):
+        self.out = out
+        self.status = ""
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            if self.status:
+                self.out.write("\r\x1b[K")
+                self.status = ""
+            return self.out.write(text)
+
+    def set_status(self, line):
+        with self.lock:
+            self.out.write("\r\x1b[K" + line)
+            self.out.flush()
+            self.status = line
+
+    def __getattr__(self, name):
+        return getattr(self.out, name)
+
+
+def show_progress(running, cond, stop, started, console):
+    tty = isinstance(console, StatusConsole)
+    while not stop.wait(PROGRESS_INTERVAL if tty else PROGRESS_INTERVAL_PLAIN):
+        now = time.time()
+        with cond:
+            parts = [st.name + " " + fmt_time(now - (st.start or now)) + " " +
+                     str(STAGE_LOGS[st.name].lines if st.name in STAGE_LOGS else 0) + " lines" for st in running]
+        line = "[" + fmt_time(now - started) + "] " + " | ".join(parts)
+        if tty:
+            console.set_status(line[:shutil.get_terminal_size().columns - 1])
+        else:
+            print(line)
+
+
+def print_log_tail(stage, log):
+    print("[" + stage + "] last " + str(len(log.tail)) + " lines of " + log.path + ":")
+    for line in log.tail:
+        print("    " + line.rstrip("\n"))
+
+
+def read_journal():
+    if not os.path.exists(JOURNAL_PATH):
+        return None
+    with open(JOURNAL_PATH) as f:
+        return json.load(f)
+
+
+def write_journal(journal):
+    tmp = JOURNAL_PATH + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(journal, f, indent=1)
+    os.replace(tmp, JOURNAL_PATH)
+
+
+def resume_targets():
+    # Arguments of the run to resume
+    journal = read_journal()
+    if not journal or journal["script"] != os.path.basename(sys.argv[0]):
+        print("No run of " + os.path.basename(sys.argv[0]) + " to resume in " + JOURNAL_PATH)
+        return None
+    if not journal["argv"]:
+        print("Interactive runs cannot be resumed, run the script with the targets instead")
+        return None
+    return journal["argv"]
+
+
+def start_journal(stages):
+    # With RESUME, the stages that completed in the journaled run, and those
+    # that were not part of it, count as done
+    old = read_journal() if RESUME else None
+    argv = [a for a in sys.argv[1:] if "--resume" != a]
+    if old:
+        argv = old["argv"]
+        for st in stages:
+            if "done" == old["stages"].get(st.name):
+                st.status = "done"
+                print("[" + st.name + "] done in the resumed run")
+            elif st.name not in old["stages"]:
+                st.status = "done"
+                print("[" + st.name + "] not part of the resumed run")
+    journal = {"script": os.path.basename(sys.argv[0]), "argv": argv,
+               "stages": dict((st.name, st.status) for st in stages)}
+    write_journal(journal)
+    return journal
+
+
+def fmt_time(seconds):
+    return "%dm%02ds" % (seconds // 60, seconds % 60)
+
+
+def critical_path(stages):
+    # Walk back from the last stage to finish through the dependency that
+    # finished last, that chain bounds the wall time of the run
+    by_name = {st.name: st for st in stages}
+    finished = [st for st in stages if st.end]
+    st = max(finished, key=lambda s: s.end) if finished else None
+    path = []
+    while st:
+        path.insert(0, st)
+        deps = [by_name[d] for d in st.deps if by_name[d].end]
+        st = max(deps, key=lambda s: s.end) if deps else None
+    return path
+
+
+def write_report(stages, num_cores, started):
+    wall = time.time() - started
+    report_stages = []
+    for st in stages:
+        steps = [dict(r, start=r["start"] - started) for r in STEP_RECORDS if st.name == r["stage"]]
+        report_stages.append({
+            "name": st.name, "status": st.status, "deps": st.deps, "jobs": st.jobs,
+            "start": st.start - started if st.start else None,
+            "wall": st.end - st.start if st.end else 0,
+            "cpu": sum(r["cpu"] for r in steps),
+            "max_rss_kb": max([r["max_rss_kb"] for r in steps] or [0]),
+            "steps": steps})
+    cpu = sum(st["cpu"] for st in report_stages)
+    path = critical_path(stages)
+    report = {"wall": wall, "cpu": cpu, "cores": num_cores,
+              "parallel_efficiency": cpu / (wall * num_cores) if wall else 0,
+              "critical_path": [st.name for st in path], "stages": report_stages}
+    with open(REPORT_PATH, "w") as f:
+        json.dump(report, f, indent=1)
+
+    print("Build report: " + REPORT_PATH)
+    print("    wall %s, cpu %s, parallel efficiency %.0f%% of %d cores" % (
+        fmt_time(wall), fmt_time(cpu), 100 * report["parallel_efficiency"], num_cores))
+    print("    critical path: " + " -> ".join("%s (%s)" % (st.name, fmt_time(st.end - st.start)) for st in path))
+    for st in sorted(report_stages, key=lambda s: -s["wall"])[:5]:
+        if st["wall"]:
+            print("    %-24s wall %9s  cpu %9s  peak rss %6d MB  %s" % (
+                st["name"], fmt_time(st["wall"]), fmt_time(st["cpu"]), st["max_rss_kb"] // 1024, st["status"]))
+
+
+def host_compiler_env(env=None):
+    # Environment for host compilations, through ccache when it is enabled
+    env = dict(env or os.environ)
+    if USE_CCACHE:
+        env.update(CC="ccache gcc", CXX="ccache g++", CCACHE_DIR=CCACHE_DIR, CCACHE_MAXSIZE=CCACHE_MAXSIZE)
+    return env
+
+
+def config_cache_env(env):
+    # env with CONFIG_SITE pointing to the cache files of this host compiler
+    # and environment
+    if not USE_CONFIG_CACHE:
+        return env
+    key = hashlib.sha256(json.dumps([host_compiler_version()] + [os.getenv(v, "") for v in STAMP_ENV_VARS]).encode())
+    path = os.path.join(CONFIG_CACHE_DIR, key.hexdigest()[:16])
+    site = os.path.join(path, "config.site")
+    if not os.path.exists(site):
+        os.makedirs(CONFIG_CACHE_DIR, exist_ok=True)
+        for name in os.listdir(CONFIG_CACHE_DIR):
+            old = os.path.join(CONFIG_CACHE_DIR, name)
+            if time.time() - os.path.getmtime(old) > CONFIG_CACHE_DAYS * 86400:
+                run("rm -rf " + old)
+        os.makedirs(path, exist_ok=True)
+        with open(site + ".tmp", "w") as f:
+            f.write(CONFIG_SITE_SCRIPT % {"site": os.getenv("CONFIG_SITE", ""), "dir": path,
+                                          "volatile": "|".join(CONFIG_CACHE_VOLATILE_ENV)})
+        os.replace(site + ".tmp", site)
+    # mtime is the last use
+    os.utime(path)
+    return dict(env, CONFIG_SITE=site)
+
+
+def ccache_stats_env(stage, env):
+    # Each stage logs its ccache results to its own file
+    if not USE_CCACHE:
+        return env
+    os.makedirs(CCACHE_STATS_DIR, exist_ok=True)
+    log = os.path.join(CCACHE_STATS_DIR, stage + ".log")
+    if os.path.exists(log):
+        os.remove(log)
+    return dict(env, CCACHE_STATSLOG=log)
+
+
+def ccache_stats(stage):
+    hits = misses = 0
+    log = os.path.join(CCACHE_STATS_DIR, stage + ".log")
+    if not os.path.exists(log):
+        return None
+    with open(log) as f:
+        for line in f:
+            line = line.strip()
+            if line in ["direct_cache_hit", "preprocessed_cache_hit", "cache hit (direct)", "cache hit (preprocessed)"]:
+                hits += 1
+            elif line in ["cache_miss", "cache miss"]:
+                misses += 1
+    return hits, misses
+
+
+def print_ccache_report(stage_names):
+    rows = [(name, ccache_stats(name)) for name in stage_names]
+    rows = [(name, st) for name, st in rows if st]
+    if not rows:
+        return
+    print("ccache (" + CCACHE_DIR + "):")
+    for name, (hits, misses) in rows:
+        rate = 100 * hits // (hits + misses) if hits + misses else 0
+        print("    %-24s %8d hits %8d misses %3d%%" % (name, hits, misses, rate))
+
+
+def repo_dir(repo):
+    name = repo.rstrip("/").split("/")[-1]
+    return name[:-4] if name.endswith(".git") else name
+
+
+def mirror_path(url):
+    key = url.split("://")[-1].rstrip("/")
+    if key.endswith(".git"):
+        key = key[:-4]
+    return os.path.join(MIRROR_DIR, key.replace("/", "_").strip("_") + ".git")
+
+
+MIRROR_RANKS = {}
+MIRROR_RANKS_LOCK = threading.Lock()
+
+
+def mirror_candidates(url):
+    cands = [url] + MIRRORS.get(url, [])
+    for prefix, replacements in MIRROR_PREFIXES.items():
+        if url.startswith(prefix):
+            cands += [r + url[len(prefix):] for r in replacements]
+    return cands
+
+
+def probe_mirror(url):
+    # Seconds to list the refs of url, None when it is unreachable
+    start = time.time()
+    try:
+        res = subprocess.run(["git", "ls-remote", url], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             timeout=PROBE_TIMEOUT, env=dict(os.environ, GIT_TERMINAL_PROMPT="0"))
+    except subprocess.TimeoutExpired:
+        return None
+    if 0 != res.returncode:
+        return None
+    return time.time() - start
+
+
+def sample_throughput(url):
+    # Bytes per second of a shallow clone of url, stopped after
+    # PROBE_SAMPLE_SECONDS or PROBE_SAMPLE_MB, None when nothing arrived
+    tmp = tempfile.mkdtemp(prefix="riscv_probe_")
+    start = time.time()
+    proc = subprocess.Popen(["git", "clone", "-q", "--bare", "--depth", "1", "--no-tags", url, os.path.join(tmp, "repo")],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True,
+                            env=dict(os.environ, GIT_TERMINAL_PROMPT="0"))
+    size = 0
+    while proc.poll() is None and time.time() - start < PROBE_SAMPLE_SECONDS and size < PROBE_SAMPLE_MB * 1024 ** 2:
+        time.sleep(0.2)
+        size = dir_size(tmp)
+    elapsed = time.time() - start
+    if proc.poll() is None:
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+    elif 0 == proc.returncode:
+        size = dir_size(tmp)
+    else:
+        size = 0
+    shutil.rmtree(tmp, ignore_errors=True)
+    return size / elapsed if size else None
+
+
+def ranked_mirrors(url):
+    # Candidates of url, the one that would fetch PROBE_RANK_MB the fastest
+    # first, probed once per run
+    with MIRROR_RANKS_LOCK:
+        if url in MIRROR_RANKS:
+            return MIRROR_RANKS[url]
+    cands = mirror_candidates(url)
+    if 1 == len(cands):
+        return cands
+    with ThreadPoolExecutor(len(cands)) as pool:
+        latencies = list(pool.map(probe_mirror, cands))
+    # Sampled one at a time, so that they do not share the bandwidth
+    rates = [sample_throughput(c) if lat is not None else None for c, lat in zip(cands, latencies)]
+    reachable = sorted((rate is None, lat + PROBE_RANK_MB * 1024 ** 2 / rate if rate else lat, c)
+                       for c, lat, rate in zip(cands, latencies, rates) if lat is not None)
+    ranked = [c for _, _, c in reachable] + [c for c, lat in zip(cands, latencies) if lat is None]
+    print("[mirrors] " + url + ": " + ", ".join(
+        c + (" unreachable" if lat is None else " %dms" % (lat * 1000) +
+             (" %dKB/s" % (rate / 1024) if rate else " no sample"))
+        for c, lat, rate in zip(cands, latencies, rates)))
+    with MIRROR_RANKS_LOCK:
+        MIRROR_RANKS[url] = ranked
+    return ranked
+
+
+def fetch_from_mirrors(url, cmd, cwd, watch):
+    # Run cmd(git) where git fetches url from its best ranked candidate. When
+    # the fetch fails or stalls, it is run again with the next candidate.
+    for cand in ranked_mirrors(url):
+        git = "git" if cand == url else "git -c url." + cand + ".insteadOf=" + url
+        if run(cmd(git), cwd, stall=(watch, STALL_TIMEOUT)):
+            return True
+        print("[mirrors] fetching " + url + " from " + cand + " failed")
+    return False
+
+
+def fetch_run(url, git, cmd, cwd, watch):
+    # A plain "git" goes to the network, one set up by mirror_git only reads
+    # the local mirror
+    if "git" == git:
+        return fetch_from_mirrors(url, cmd, cwd, watch)
+    return run(cmd(git), cwd)
+
+
+def update_mirror(url, filter_spec=None):
+    # Create or fetch the bare mirror of url, returns its path
+    path = mirror_path(url)
+    tmp = path + ".tmp"
+    if OFFLINE:
+        if not os.path.exists(path):
+            print("[offline] " + url + " is not in " + MIRROR_DIR + ", import a bundle with it first")
+            return None
+        return path
+    os.makedirs(MIRROR_DIR, exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(path):
+            ok = fetch_from_mirrors(url, lambda git: git + " fetch --prune origin", path, [path])
+        else:
+            opts = " --filter=" + filter_spec if filter_spec else ""
+            ok = fetch_from_mirrors(url, lambda git: "rm -rf " + tmp + " && " + git + " clone --mirror" + opts + " " +
+                                    url + " " + tmp, None, [tmp]) and run("mv " + tmp + " " + path)
+    return path if ok else None
+
+
+def mirror_git(urls):
+    # git command line that transparently fetches every url from its mirror.
+    # file:// keeps git from hardlinking or copying the mirror's packs, the
+    # objects are only reached through alternates.
+    cmd = "git -c protocol.file.allow=always"
+    for url in urls:
+        cmd += " -c url.file://" + mirror_path(url) + ".insteadOf=" + url
+    return cmd
+
+
+def add_alternate(path, mirror):
+    alternates = os.path.join(path, ".git", "objects", "info", "alternates")
+    objects = os.path.join(mirror, "objects")
+    current = open(alternates).read().split() if os.path.exists(alternates) else []
+    if objects not in current:
+        with open(alternates, "a") as f:
+            f.write(objects + "\n")
+
+
+def fetch_args(name, url, ref=None):
+    # (git command, clone options, mirror) for url according to its fetch
+    # policy, None when the mirror could not be updated
+    policy = FETCH_POLICIES.get(name, {})
+    if OFFLINE:
+        # Imported mirrors are shallow, they cannot serve as --reference
+        mirror = update_mirror(url)
+        return (mirror_git([url]), "", mirror) if mirror else None
+    if "depth" in policy:
+        return "git", " --depth " + str(policy["depth"]), None
+    git, opts, mirror = "git", "", None
+    if "filter" in policy:
+        opts += " --filter=" + policy["filter"]
+    if USE_MIRROR:
+        mirror = update_mirror(url, policy.get("filter"))
+        if not mirror:
+            return None
+        if "filter" not in policy:
+            # A partial mirror has no blobs to serve, those come from url
+            git = mirror_git([url])
+        ref = ref or mirror
+    if ref:
+        opts += " --reference " + ref
+    return git, opts, mirror
 
 
 def clone_repo(repo):
+    # Clone repo into WORK_DIR, or fetch it when the checkout already exists
+    name = repo_dir(repo)
+    path = os.path.join(WORK_DIR, name)
+    args = fetch_args(name, repo)
+    if not args:
+        return False
+    git, opts, mirror = args
+    branch = FETCH_POLICIES.get(name, {}).get("branch")
+    if os.path.exists(os.path.join(path, ".git")):
+        print(repo + " fetching")
+        if mirror:
+            add_alternate(path, mirror)
+        if branch:
+            depth = " --depth " + str(FETCH_POLICIES[name]["depth"]) if "depth" in FETCH_POLICIES[name] else ""
+            return fetch_run(repo, git, lambda g: g + " fetch" + depth + " origin +refs/heads/" + branch +
+                             ":refs/remotes/origin/" + branch + " && git reset -q --hard origin/" + branch, path, [path])
+        return fetch_run(repo, git, lambda g: g + " fetch --prune origin && " + g +
+                         " remote set-head origin -a && git reset -q --hard origin/HEAD", path, [path])
     print(repo + " cloning")
-    os.system("git clone " + repo)
+    if branch:
+        opts += " --branch " + branch
+    return fetch_run(repo, git, lambda g: "rm -rf " + path + " && " + g + " clone" + opts + " " + repo + " " + path,
+                     None, [path])
 
 
-def clone_riscv_repos(auto=False):
-    opt_clone_repo = 'N'
-    if not auto:
-        opt_clone_repo = input(
-            "Re-clone riscv-gnu-toolchain, riscv-isa-sim (spike), riscv-pk? (y/[N]) >>> "
-        )
-    else:
-        opt_clone_repo = 'y'
+def ask_clone(question, auto=False):
+    # A resumed run plans every clone, the journal tells which ones are needed
+    if auto or RESUME or ASSUME_YES:
+        return True
+    if input(question) in ['y', 'Y']:
+        return True
+    print("Skip cloning...")
+    return False
 
-    if opt_clone_repo in ['y', 'Y']:
-        if os.path.exists("riscv-gnu-toolchain"):
-            os.system("rm -rf riscv-gnu-toolchain")
-        if os.path.exists("riscv-pk"):
-            os.system("rm -rf riscv-pk")
-        if os.path.exists("riscv-isa-sim"):
-            os.system("rm -rf riscv-isa-sim")
 
+def clone_riscv_repos(auto=False):
+    if ask_clone("Clone or update riscv-gnu-toolchain, riscv-isa-sim (spike), riscv-pk? (y/[N]) >>> ", auto):
         with Pool(len(RISCV_REPOS)) as pl:
-            pl.map(clone_repo, RISCV_REPOS)
+            return all(pl.map(clone_repo, RISCV_REPOS))
+    return True
+
+
+SCRATCH_BUILDS = {}
+SCRATCH_DONE = set()
+SCRATCH_BUDGET = []
+SCRATCH_LOCK = threading.Lock()
+
+
+def scratch_budget():
+    # Bytes the build directories on SCRATCH_DIR may take
+    if "auto" != SCRATCH_GB:
+        return float(SCRATCH_GB) * (1 << 30)
+    os.makedirs(SCRATCH_DIR, exist_ok=True)
+    st = os.statvfs(SCRATCH_DIR)
+    return min(available_memory() // 2, st.f_bavail * st.f_frsize)
+
+
+def reserve_scratch(build, footprint_gb):
+    # The scratch tree for build, or None to build on disk
+    if not SCRATCH_DIR or not footprint_gb:
+        return None
+    with SCRATCH_LOCK:
+        if not SCRATCH_BUDGET:
+            SCRATCH_BUDGET.append(scratch_budget())
+        left = SCRATCH_BUDGET[0] / float(1 << 30) - sum(SCRATCH_BUILDS.values())
+        if footprint_gb > left:
+            print("[scratch] %s needs ~%g GB, %.1f GB of the budget left, building on disk" % (
+                build, footprint_gb, max(left, 0)))
+            return None
+        SCRATCH_BUILDS[build] = footprint_gb
+    return os.path.join(SCRATCH_DIR, os.path.basename(build) + "-" + hashlib.sha1(build.encode()).hexdigest()[:12])
+
+
+def release_scratch(build):
+    # Replace a build directory on scratch by one on disk holding only its
+    # stamp, marked as released so that the next build starts over
+    if not os.path.islink(build):
+        return
+    stamp = read_stamp(build)
+    scratch = os.path.dirname(os.readlink(build))
+    src = os.path.dirname(build)
+    for entry in os.listdir(scratch):
+        path = os.path.join(scratch, entry)
+        if entry != os.path.basename(build) and not os.path.islink(path) and not os.path.lexists(os.path.join(src, entry)):
+            # Written next to the build directory, e.g. ../install
+            shutil.move(path, os.path.join(src, entry))
+    run("rm -rf " + scratch)
+    os.remove(build)
+    with SCRATCH_LOCK:
+        SCRATCH_BUILDS.pop(build, None)
+        SCRATCH_DONE.discard(build)
+    if stamp:
+        os.mkdir(build)
+        write_stamp(build, dict(stamp, released=True))
+
+
+def release_finished_scratch():
+    # pk and spike are installed from their build directories after the build,
+    # so these are freed at the end of the run
+    for build in sorted(SCRATCH_DONE):
+        release_scratch(build)
+
+
+def remkdir_build(src, name="build", footprint_gb=0):
+    build = os.path.join(src, name)
+    release_scratch(build)
+    if os.path.exists(build):
+        run("rm -rf " + build)
+    scratch = reserve_scratch(build, footprint_gb)
+    if not scratch:
+        os.mkdir(build)
+        return build
+    # The scratch tree links to everything else in src, so the relative paths
+    # of the build (../configure, ../install) still lead to the source tree
+    run("rm -rf " + scratch)
+    os.makedirs(os.path.join(scratch, name))
+    for entry in os.listdir(src):
+        if entry != name:
+            os.symlink(os.path.join(src, entry), os.path.join(scratch, entry))
+    os.symlink(os.path.join(scratch, name), build)
+    print("[scratch] " + build + " on " + scratch)
+    return build
+
+
+def use_branch(branch):
+    # Builds the GNU targets from branch of riscv-gnu-toolchain instead of
+    # the branches of TOOLCHAIN_SOURCES, keeping their .gitmodules and gcc
+    # branch. The worktrees and prefixes (riscv_install@<branch>/elf, ...)
+    # are separate from those of the default branches.
+    name = branch.replace("/", "_")
+    for source, spec in list(TOOLCHAIN_SOURCES.items()):
+        TOOLCHAIN_SOURCES[source + "@" + name] = dict(spec, branch=branch)
+    for spec in TARGET_MATRIX.values():
+        spec["source"] += "@" + name
+        root, tg = os.path.split(spec["prefix"])
+        spec["prefix"] = os.path.join(root + "@" + name, tg)
+
+
+def parse_options(targets):
+    # Sets the options given on the command line of both scripts and returns
+    # the remaining arguments, or None when they are wrong
+    global RESUME, OFFLINE, ASSUME_YES, MULTILIB, BUILD_PROFILE, BRANCH
+    targets = list(targets)
+
+    if "--resume" in targets:
+        # Run the last command again, skipping the stages it completed
+        RESUME = True
+        targets = resume_targets()
+        if targets is None:
+            return None
+
+    if "--offline" in targets:
+        OFFLINE = True
+        targets.remove("--offline")
+
+    if "--yes" in targets:
+        ASSUME_YES = True
+        targets.remove("--yes")
+
+    if "--multilib" in targets:
+        MULTILIB = True
+        targets.remove("--multilib")
+
+    for arg in [a for a in targets if a.startswith("--profile=")]:
+        BUILD_PROFILE = arg[len("--profile="):]
+        targets.remove(arg)
+    if BUILD_PROFILE not in BUILD_PROFILES:
+        print("Invalid profile! " + BUILD_PROFILE + ", one of " + " ".join(BUILD_PROFILES))
+        return None
+
+    for arg in [a for a in targets if a.startswith("--branch=")]:
+        BRANCH = arg[len("--branch="):]
+        targets.remove(arg)
+    if BRANCH:
+        use_branch(BRANCH)
+    return targets
+
+
+def target_prefix(tg):
+    return TARGET_MATRIX[tg]["prefix"]
+
+
+def target_source(tg):
+    return TARGET_MATRIX[tg]["source"]
+
+
+def worktree_path(tg):
+    return os.path.join(WORKTREE_DIR, "riscv-gnu-toolchain-" + target_source(tg))
+
+
+def cmd_output(cmd, cwd):
+    res = subprocess.run(cmd, shell=True, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                         universal_newlines=True)
+    return res.stdout.strip() if 0 == res.returncode else None
+
+
+def gitmodules(src, config="-f .gitmodules"):
+    # [(name, path, url)] of the submodules listed in src/.gitmodules, or in
+    # the file or blob given by config
+    out = cmd_output("git config " + config + " --get-regexp '^submodule\\..*\\.(path|url)$'", src) or ""
+    modules = {}
+    for line in out.splitlines():
+        key, value = line.split(" ", 1)
+        name, field = key[len("submodule."):].rsplit(".", 1)
+        modules.setdefault(name, {})[field] = value
+    return [(name, m["path"], m["url"]) for name, m in modules.items() if "path" in m and "url" in m]
+
+
+def profile_submodules(libcs):
+    # Paths of the submodules BUILD_PROFILE checks out for targets using
+    # libcs, None for all of them
+    paths = BUILD_PROFILES[BUILD_PROFILE]["submodules"]
+    return None if paths is None else paths + sorted(set(libcs))
+
+
+def update_submodules(src, ref_root=None, paths=None):
+    # Check out every submodule in paths (all if None) except qemu,
+    # SUBMODULE_JOBS at a time. The objects are borrowed from the same
+    # submodule under ref_root or from the mirror.
+    modules = [m for m in gitmodules(src) if "qemu" != m[1] and (paths is None or m[1] in paths)]
+    if not modules:
+        return True
+    stage = getattr(STAGE_CONTEXT, "name", None)
+    # init writes .git/config, so it runs once before the parallel updates
+    if not run("git submodule init -- " + " ".join(path for _, path, _ in modules), src):
+        return False
+
+    def update(module):
+        STAGE_CONTEXT.name = stage
+        name, path, url = module
+        ref = None
+        if ref_root and os.path.exists(os.path.join(ref_root, path, ".git")):
+            ref = os.path.join(ref_root, path)
+        args = fetch_args(path, url, ref)
+        if not args:
+            return False
+        git, opts, _ = args
+        # Objects go to the modules directory of the repository, files to path
+        modules = os.path.join(src, cmd_output("git rev-parse --git-dir", src) or ".git", "modules", name)
+        return fetch_run(url, git, lambda g: g + " submodule update --init --recursive" + opts + " -- " + path,
+                         src, [os.path.join(src, path), modules])
+
+    with ThreadPoolExecutor(SUBMODULE_JOBS) as pool:
+        return all(list(pool.map(update, modules)))
+
+
+def fetch_gitmodules(paths=None):
+    # Fetch the submodules once in the main checkout, the per-target worktrees
+    # borrow their objects from the mirror or through --reference
+    src = os.path.join(WORK_DIR, "riscv-gnu-toolchain")
+    run("git rm qemu", src)
+    return update_submodules(src, paths=paths)
+
+
+def update_gitmodules(source, paths=None):
+    main = os.path.join(WORK_DIR, "riscv-gnu-toolchain")
+    src = os.path.join(WORKTREE_DIR, "riscv-gnu-toolchain-" + source)
+    spec = TOOLCHAIN_SOURCES[source]
+    rev = "origin/" + spec["branch"]
+    if not os.path.exists(src):
+        os.makedirs(WORKTREE_DIR, exist_ok=True)
+        if not run("git worktree prune && git worktree add --detach -f " + src + " " + rev, main):
+            return False
+    elif cmd_output("git rev-parse HEAD", src) != cmd_output("git rev-parse " + rev, main):
+        # Only files that differ between the revisions are rewritten
+        if not run("git checkout --detach -f " + rev, src):
+            return False
+
+    if spec["gitmodules"]:
+        with open(os.path.join(src, ".gitmodules")) as f:
+            current = f.read()
+        if current != spec["gitmodules"]:
+            with open(os.path.join(src, ".gitmodules"), "w") as f:
+                f.write(spec["gitmodules"])
+    if os.path.exists(os.path.join(src, "qemu")):
+        run("git rm -q qemu", src)
+    if not run("git submodule sync -q", src):
+        return False
+    if not update_submodules(src, main, paths):
+        return False
+    # The worktree is kept between runs, so the gcc branch is fetched before
+    # riscv-gcc is reset to it
+    gcc = spec["gcc"]
+    url = [u for _, path, u in gitmodules(src) if "riscv-gcc" == path]
+    args = fetch_args("riscv-gcc", url[0]) if url else None
+    if not args:
+        return False
+    git_dir = cmd_output("git rev-parse --absolute-git-dir", os.path.join(src, "riscv-gcc"))
+    if not fetch_run(url[0], args[0], lambda g: g + " fetch -q origin +refs/heads/" + gcc + ":refs/remotes/origin/" + gcc,
+                     os.path.join(src, "riscv-gcc"), [git_dir]):
+        return False
+    GCC_BRANCH = "cd riscv-gcc && git reset --hard origin/" + gcc + " && cd .."
+    return run(GCC_BRANCH, src)
+
+
+def source_revisions(src):
+    # Commit of the repo and each submodule, with a hash of uncommitted changes.
+    # Changes in a submodule only count for its own entry.
+    revs = {}
+    out = cmd_output("git rev-parse HEAD && git diff HEAD --ignore-submodules | git hash-object --stdin", src) or ""
+    revs["."] = " ".join(out.split())
+    out = cmd_output("git submodule foreach --quiet --recursive 'echo $displaypath $(git rev-parse HEAD) "
+                     "$(git diff HEAD --ignore-submodules | git hash-object --stdin)'", src) or ""
+    for line in out.splitlines():
+        path, rev = line.split(" ", 1)
+        revs[path] = rev
+    return revs
+
+
+def config_stamp(configure, env=None):
+    env = env or os.environ
+    return {"configure": configure, "env": dict((k, env.get(k, "")) for k in STAMP_ENV_VARS)}
+
+
+def stage_stamp(src, configure, env=None):
+    return dict(config_stamp(configure, env), sources=source_revisions(src))
+
+
+def read_stamp(build):
+    try:
+        with open(os.path.join(build, STAMP_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_stamp(build, stamp):
+    with open(os.path.join(build, STAMP_NAME), "w") as f:
+        json.dump(stamp, f, indent=1, sort_keys=True)
+
+
+def same_config(old, stamp):
+    return old is not None and old["configure"] == stamp["configure"] and old["env"] == stamp["env"]
+
+
+def prepare_build(src, name, stamp, installed, full=False, footprint_gb=0):
+    # Returns the build directory, the build mode ("skip", "incremental" or
+    # "full") and the previous stamp
+    build = os.path.join(src, name)
+    if os.path.islink(build):
+        # Left on scratch by an earlier run
+        with SCRATCH_LOCK:
+            SCRATCH_BUILDS.setdefault(build, footprint_gb)
+    old = read_stamp(build) if INCREMENTAL_BUILD and not full else None
+    if same_config(old, stamp) and old["sources"] == stamp["sources"] and os.path.exists(installed):
+        return build, "skip", old
+    if same_config(old, stamp) and not old.get("released"):
+        # Until the build succeeds, only the sources that did not change count as built
+        kept = dict((k, v) for k, v in old["sources"].items() if stamp["sources"].get(k) == v)
+        write_stamp(build, dict(stamp, sources=kept))
+        return build, "incremental", old
+    # Without a stamp until configure_build succeeds
+    remkdir_build(src, name, footprint_gb)
+    return build, "full", None
+
+
+def configure_build(build, mode, stamp, configure, env=None):
+    # Runs configure for a full build. The stamp records the configuration
+    # only once it succeeded, so a failed configure is run again next time.
+    if "full" != mode:
+        return True
+    if not run(configure, build, env):
+        return False
+    write_stamp(build, dict(stamp, sources={}))
+    return True
+
+
+def target_triple(tg):
+    spec = TARGET_MATRIX[tg]
+    return "riscv" + str(spec["xlen"]) + ("-unknown-linux-gnu" if "glibc" == spec["libc"] else "-unknown-elf")
+
+
+def target_arch_abi(tg):
+    spec = TARGET_MATRIX[tg]
+    if "arch" in spec:
+        return spec["arch"], spec["abi"]
+    return "rv" + str(spec["xlen"]) + "gc", "lp64d" if 64 == spec["xlen"] else "ilp32d"
+
+
+def multilib_target(libc, group):
+    # Adds the shared compiler of the targets in group to TARGET_MATRIX. It
+    # is built from the source of a vector target if there is one, as the
+    # rvv branches also handle the scalar multilibs.
+    name = "multilib-" + libc
+    widest = max(group, key=lambda tg: TARGET_MATRIX[tg]["xlen"])
+    xlen = TARGET_MATRIX[widest]["xlen"]
+    vector = [tg for tg in group if "v" in target_arch_abi(tg)[0][4:]]
+    spec = {"xlen": xlen, "libc": libc, "source": target_source((vector or group)[0]),
+            "prefix": os.path.join(os.path.dirname(target_prefix(widest)), name),
+            "multilib": sorted(set("-".join(target_arch_abi(tg)) for tg in group))}
+    if 32 == xlen:
+        spec.update(arch="rv32gc", abi="ilp32d")
+    TARGET_MATRIX[name] = spec
+    return name
+
+
+def multilib_wrappers(tg, ml):
+    # The tools of tg in its prefix, running those of the multilib compiler
+    # ml with the arch/abi of tg
+    src_bin = os.path.join(target_prefix(ml), "bin")
+    dst_bin = os.path.join(target_prefix(tg), "bin")
+    src_triple, triple = target_triple(ml), target_triple(tg)
+    arch, abi = target_arch_abi(tg)
+    os.makedirs(dst_bin, exist_ok=True)
+    for name in sorted(os.listdir(src_bin)):
+        if not name.startswith(src_triple + "-"):
+            continue
+        tool = name[len(src_triple) + 1:]
+        flags = ""
+        if tool in MULTILIB_DRIVERS or (triple != src_triple and "as" == tool):
+            flags = " -march=" + arch + " -mabi=" + abi
+        elif triple != src_triple and tool in ["ld", "ld.bfd"]:
+            # riscv32 names for the riscv64 tools
+            flags = " -m elf32lriscv"
+        path = os.path.join(dst_bin, triple + "-" + tool)
+        # A new file, not one linked with other prefixes by `slim`
+        if os.path.lexists(path):
+            os.remove(path)
+        with open(path, "w") as f:
+            f.write('#!/bin/sh\nexec ' + os.path.join(src_bin, name) + flags + ' "$@"\n')
+        os.chmod(path, 0o755)
+    print("[toolchain-" + tg + "] " + dst_bin + " runs " + src_bin + " with -march=" + arch + " -mabi=" + abi)
+    return True
+
+
+def gnu_target_cmds(tg, install_path, jobs):
+    spec = TARGET_MATRIX[tg]
+    TOOLCHAIN_CONFIG_CMD = "../configure"
+    if "arch" in spec:
+        TOOLCHAIN_CONFIG_CMD += " --with-arch=" + spec["arch"] + " --with-abi=" + spec["abi"]
+    if "multilib" in spec and "newlib" == spec["libc"]:
+        TOOLCHAIN_CONFIG_CMD += " --with-multilib-generator='" + ";".join(ml + "--" for ml in spec["multilib"]) + "'"
+    elif "multilib" in spec:
+        # gcc only takes a multilib generator for riscv*-*-elf, glibc is built
+        # for its default linux multilibs
+        TOOLCHAIN_CONFIG_CMD += " --enable-multilib"
+    if not BUILD_PROFILES[BUILD_PROFILE]["gdb"]:
+        TOOLCHAIN_CONFIG_CMD += " --disable-gdb"
+    TOOLCHAIN_CONFIG_CMD += " --prefix=" + install_path
+    TOOLCHAIN_MAKE_CMD = ("make linux -j" if "glibc" == spec["libc"] else "make -j") + str(jobs)
+    return TOOLCHAIN_CONFIG_CMD, TOOLCHAIN_MAKE_CMD
+
+
+def build_gnu_toolchain(tg, jobs):
+    src = worktree_path(tg)
+    INSTALL_PATH = target_prefix(tg)
+    TOOLCHAIN_CONFIG_CMD, TOOLCHAIN_MAKE_CMD = gnu_target_cmds(tg, INSTALL_PATH, jobs)
+    env = config_cache_env(ccache_stats_env("toolchain-" + tg, host_compiler_env()))
+    stamp = stage_stamp(src, TOOLCHAIN_CONFIG_CMD, env)
+    footprint_gb = BUILD_FOOTPRINT_GB[TARGET_MATRIX[tg]["libc"]]
+    build, mode, old = prepare_build(src, "build-" + tg, stamp, INSTALL_PATH + "/bin", footprint_gb=footprint_gb)
+    if "skip" == mode:
+        print("[toolchain-" + tg + "] up to date")
+        release_scratch(build)
+        return True
+    if "incremental" == mode:
+        changed = [k for k in stamp["sources"] if old["sources"].get(k) != stamp["sources"][k]]
+        if "." in changed or not os.path.exists(INSTALL_PATH + "/bin") or \
+                [k for k in changed if k.split("/")[0] not in TOOLCHAIN_COMPONENT_STAMPS]:
+            build, mode, old = prepare_build(src, "build-" + tg, stamp, INSTALL_PATH, full=True,
+                                             footprint_gb=footprint_gb)
+        else:
+            for k in changed:
+                run("rm -f stamps/" + TOOLCHAIN_COMPONENT_STAMPS[k.split("/")[0]] + "*", build)
+    # make install may write into files linked with other prefixes by `slim`
+    unshare_prefix(INSTALL_PATH)
+    start = time.time()
+    ok = configure_build(build, mode, stamp, TOOLCHAIN_CONFIG_CMD, env) and run(TOOLCHAIN_MAKE_CMD, build, env)
+    record_toolchain_components(build, start)
+    if not ok:
+        return False
+    write_stamp(build, stamp)
+    # Everything the build produced is installed in the prefix
+    release_scratch(build)
+    return True
+
+
+def record_toolchain_components(build, start):
+    # riscv-gnu-toolchain touches stamps/<component> when a component is
+    # installed, the gaps between them time binutils, gcc stage 1, libc, ...
+    stamps = os.path.join(build, "stamps")
+    if not os.path.isdir(stamps):
+        return
+    done = sorted((os.path.getmtime(os.path.join(stamps, name)), name) for name in os.listdir(stamps))
+    prev = start
+    for mtime, name in done:
+        if mtime < start:
+            continue
+        STEP_RECORDS.append({"stage": getattr(STAGE_CONTEXT, "name", None), "cmd": "component " + name,
+                             "cwd": build, "start": prev, "wall": mtime - prev, "cpu": 0, "max_rss_kb": 0,
+                             "status": 0})
+        prev = mtime
+
+
+def build_configured(stage, src, build_name, configure, make, installed, env=None, footprint_gb=0):
+    # configure + make in a build directory, skipped or rebuilt in place
+    # according to its stamp
+    stamp = stage_stamp(src, configure, env)
+    build, mode, _ = prepare_build(src, build_name, stamp, installed, footprint_gb=footprint_gb)
+    if "skip" != mode:
+        if not configure_build(build, mode, stamp, configure, env) or not run(make, build, env):
+            return False
+        write_stamp(build, stamp)
     else:
-        print("Skip cloning repos...")
+        print("[" + stage + "] up to date")
+    if os.path.islink(build):
+        with SCRATCH_LOCK:
+            SCRATCH_DONE.add(build)
+    return True
+
+
+def pk_build_env(tg):
+    return dict(os.environ, PATH=target_prefix(tg) + "/bin:" + ENV_PATH)
+
+
+# pk only depends on the host triple, so it is built once per triple and
+# installed into every prefix with `make install prefix=...`. spike looks up
+# programs given by name (`spike pk hello`) under its configure prefix, so it
+# is built once per install root (riscv_install, riscv_install_32, ...),
+# installed into every prefix of the root, and pk is also installed under
+# the root.
+def install_root(tg):
+    return os.path.dirname(target_prefix(tg))
+
+
+def pk_config_cmd(triple):
+    cmd = "../configure --host=" + triple + " CC=" + triple + "-gcc --prefix=" + RISCV_INSTALL
+    if triple.startswith("riscv32"):
+        cmd += " --with-arch=rv32gc"
+    return cmd
+
+
+def spike_config_cmd(root):
+    return "../configure --prefix=" + root
+
+
+def pk_build_dir(triple):
+    return os.path.join(WORK_DIR, "riscv-pk", "build-" + triple)
+
+
+def spike_build_dir(root):
+    return os.path.join(WORK_DIR, "riscv-isa-sim", "build-" + os.path.basename(root))
+
+
+def build_riscv_pk(triple, tg, jobs):
+    # Built with the compiler of tg, one of the targets with this host triple
+    return build_configured("pk-" + triple, os.path.join(WORK_DIR, "riscv-pk"), "build-" + triple,
+                            pk_config_cmd(triple), "make -j" + str(jobs),
+                            os.path.join(pk_build_dir(triple), "pk"), config_cache_env(pk_build_env(tg)),
+                            BUILD_FOOTPRINT_GB["pk"])
+
+
+def build_riscv_spike(root, jobs):
+    stage = "spike-" + os.path.basename(root)
+    return build_configured(stage, os.path.join(WORK_DIR, "riscv-isa-sim"), os.path.basename(spike_build_dir(root)),
+                            spike_config_cmd(root), "make -j" + str(jobs),
+                            os.path.join(spike_build_dir(root), "spike"),
+                            config_cache_env(ccache_stats_env(stage, host_compiler_env())),
+                            BUILD_FOOTPRINT_GB["spike"])
+
+
+def install_shared(build, tg, env=None):
+    return run("make install prefix=" + target_prefix(tg), build, env)
+
+
+def install_root_pk(tg):
+    # The pk of tg, under the install root where its spike looks for it
+    rel = os.path.join(target_triple(tg), "bin", "pk")
+    dst = os.path.join(install_root(tg), rel)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = dst + "." + tg + ".tmp"
+    shutil.copy2(os.path.join(target_prefix(tg), rel), tmp)
+    os.replace(tmp, dst)
+    return True
+
+
+def pk_compiler(group):
+    # pk is built without --with-arch for riscv64, so not with the compiler
+    # of a vector target when the group has a scalar one
+    scalar = [tg for tg in group if "v" not in target_arch_abi(tg)[0][4:]]
+    return (scalar or group)[0]
+
+
+def toolchain_build_dir(tg):
+    return os.path.join(worktree_path(tg), "build-" + tg)
+
+
+def drop_stamps(builds):
+    for build in builds:
+        stamp = os.path.join(build, STAMP_NAME)
+        if os.path.exists(stamp):
+            os.remove(stamp)
+
+
+def multilib_wrapped(tg):
+    # The compiler in the prefix of tg is one of the wrappers of MULTILIB
+    gcc = os.path.join(target_prefix(tg), "bin", target_triple(tg) + "-gcc")
+    try:
+        with open(gcc, "rb") as f:
+            return f.read(10) == b"#!/bin/sh\n"
+    except OSError:
+        return False
+
+
+def clean_prefix(tg, wrappers=False):
+    # The prefix only starts over when the toolchain is configured differently
+    # or switches between a compiler and the wrappers of MULTILIB, pk and
+    # spike are installed into it on every run
+    INSTALL_PATH = target_prefix(tg)
+    if wrappers and multilib_wrapped(tg):
+        return True
+    old = read_stamp(toolchain_build_dir(tg)) if INCREMENTAL_BUILD else None
+    if not wrappers and not multilib_wrapped(tg) and \
+            same_config(old, config_stamp(gnu_target_cmds(tg, INSTALL_PATH, 1)[0], host_compiler_env())):
+        return True
+    if os.path.exists(INSTALL_PATH):
+        return run("rm -rf " + INSTALL_PATH)
+    return True
+
+
+HOST_COMPILER = []
+
+
+def host_compiler_version():
+    if not HOST_COMPILER:
+        HOST_COMPILER.append(cmd_output("gcc --version | head -1 && g++ --version | head -1", WORK_DIR))
+    return HOST_COMPILER[0]
 
 
-def remkdir_cd_build():
-    if os.path.exists("build"):
-        os.system("rm -rf build")
-    os.mkdir("build")
-    os.chdir("build")
+def without_ccache(text):
+    return text.replace(LLVM_CCACHE_FLAGS, "").replace("ccache ", "")
 
 
-def update_gitmodules(target):
-    os.chdir("riscv-gnu-toolchain")
-    if target in ["elf-rvv", "linux-rvv"]:
-        os.system("git reset --hard && git checkout rvv-next")
-        os.system("git rm qemu")
-        with open(".gitmodules", "w") as f:
-            f.write(DOT_GITMODULES)
+def artifact_key(stamps):
+    # PATH and ccache differ between machines without changing what gets built
+    stamps = dict((k, dict(v, configure=without_ccache(v["configure"]),
+                           env=dict((e, without_ccache(x)) for e, x in v["env"].items() if "PATH" != e)))
+                  for k, v in stamps.items())
+    data = json.dumps({"stamps": stamps, "compiler": host_compiler_version()}, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def find_artifact(key):
+    for ext in [".tar.zst", ".tar.gz"]:
+        if os.path.exists(os.path.join(ARTIFACT_DIR, key + ext)):
+            return os.path.join(ARTIFACT_DIR, key + ext)
+    return None
+
+
+def tar_compress_opt(archive, jobs=1):
+    if archive.endswith(".zst"):
+        return '--use-compress-program="zstd -q -T' + str(jobs) + '"'
+    return "-z"
+
+
+def stamp_current(build, stamp):
+    old = read_stamp(build) if INCREMENTAL_BUILD else None
+    return same_config(old, stamp) and old["sources"] == stamp["sources"]
+
+
+def restore_artifact(stage, key, prefix, builds, installed):
+    # builds maps the build directories of prefix to the stamps the cached
+    # build had. A local build with those stamps is used as it is, so its
+    # build directories stay for in-place rebuilds.
+    if os.path.exists(installed) and all(stamp_current(b, st) for b, st in builds.items()):
+        print("[" + stage + "] local build is up to date")
+        return False
+    archive = find_artifact(key) if USE_ARTIFACT_CACHE else None
+    if not archive:
+        print("[" + stage + "] no cached build " + key[:16])
+        return False
+    print("[" + stage + "] restoring " + archive)
+    # mtime is the last use for the LRU eviction
+    os.utime(archive)
+    parent = os.path.dirname(prefix)
+    run("rm -rf " + prefix)
+    os.makedirs(parent, exist_ok=True)
+    if not run("tar " + tar_compress_opt(archive) + " -xf " + archive + " -C " + parent):
+        run("rm -rf " + prefix)
+        return False
+    # The other build directories no longer match what is installed
+    drop_stamps([b for b, st in builds.items() if not stamp_current(b, st)])
+    return True
+
+
+def pack_artifact(stage, key, prefix, info, jobs=1):
+    if not USE_ARTIFACT_CACHE or find_artifact(key):
+        return True
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    archive = os.path.join(ARTIFACT_DIR, key + (".tar.zst" if shutil.which("zstd") else ".tar.gz"))
+    tmp = archive + "." + str(os.getpid()) + ".tmp"
+    parent, name = os.path.split(prefix)
+    if run("tar " + tar_compress_opt(archive, jobs) + " -cf " + tmp + " -C " + parent + " " + name):
+        with open(os.path.join(ARTIFACT_DIR, key + ".json"), "w") as f:
+            json.dump(dict(info, compiler=host_compiler_version()), f, indent=1, sort_keys=True)
+        os.rename(tmp, archive)
+        evict_artifacts()
     else:
-        os.system("git reset --hard && git checkout master")
-        os.system("git rm qemu")
-    os.system("git submodule update --init --recursive")
-    os.chdir("..")
+        # A missing archive only costs a rebuild next time
+        print("[" + stage + "] could not pack " + prefix)
+        run("rm -f " + tmp)
+    return True
+
+
+def evict_artifacts():
+    with open(os.path.join(ARTIFACT_DIR, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archives = []
+        for name in os.listdir(ARTIFACT_DIR):
+            if name.endswith(".tar.zst") or name.endswith(".tar.gz"):
+                st = os.stat(os.path.join(ARTIFACT_DIR, name))
+                archives.append((st.st_mtime, st.st_size, name))
+        total = sum(a[1] for a in archives)
+        for _, size, name in sorted(archives):
+            if total <= ARTIFACT_CACHE_GB * 1024 ** 3:
+                break
+            print("Evicting cached build " + name)
+            os.remove(os.path.join(ARTIFACT_DIR, name))
+            info = os.path.join(ARTIFACT_DIR, name.split(".")[0] + ".json")
+            if os.path.exists(info):
+                os.remove(info)
+            total -= size
+
 
+def target_artifact(tg):
+    # (key, description) of everything installed into the prefix of tg
+    INSTALL_PATH = target_prefix(tg)
+    cmds = gnu_target_cmds(tg, INSTALL_PATH, 1)
+    stamps = {"toolchain": stage_stamp(worktree_path(tg), cmds[0], host_compiler_env())}
+    if BUILD_PROFILES[BUILD_PROFILE]["spike"]:
+        stamps["pk"] = stage_stamp(os.path.join(WORK_DIR, "riscv-pk"), pk_config_cmd(target_triple(tg)), pk_build_env(tg))
+        stamps["spike"] = stage_stamp(os.path.join(WORK_DIR, "riscv-isa-sim"), spike_config_cmd(install_root(tg)), host_compiler_env())
+    return artifact_key(stamps), {"prefix": INSTALL_PATH, "stamps": stamps}
 
-def build_riscv64_tools(targets):
+
+def restore_target(tg, restored):
+    key, info = target_artifact(tg)
+    if restore_artifact("cache-" + tg, key, target_prefix(tg), {toolchain_build_dir(tg): info["stamps"]["toolchain"]},
+                        target_prefix(tg) + "/bin"):
+        restored.add(tg)
+    return True
+
+
+def pack_target(tg, jobs):
+    key, info = target_artifact(tg)
+    return pack_artifact("pack-" + tg, key, info["prefix"], info, jobs)
+
+
+def gnu_stages(targets, clone=False):
+    # clone -> submodules -> worktree -> toolchain -> pk. Each target has its
+    # own build directory in the worktree of its source, so the targets build
+    # side by side. Worktrees are checked out once per source, pk is built
+    # once per host triple and spike once per install root, both are
+    # installed into every prefix. Without spike in BUILD_PROFILE the targets
+    # only get the toolchain.
+    stages = []
+    clone_deps = {}
+    spike = BUILD_PROFILES[BUILD_PROFILE]["spike"]
+    for repo in RISCV_REPOS:
+        name = repo_dir(repo)
+        clone_deps[name] = []
+        if clone and (spike or "riscv-gnu-toolchain" == name):
+            stages.append(Stage("clone-" + name, lambda jobs, repo=repo: clone_repo(repo)))
+            clone_deps[name] = ["clone-" + name]
+
+    invalid = [tg for tg in targets if tg not in TARGET_MATRIX or "multilib" in TARGET_MATRIX[tg]]
+    if invalid:
+        print("Invalid target! " + " ".join(invalid))
+    targets = [tg for tg in targets if tg not in invalid]
     if not targets:
-        return
+        return stages
+    paths = profile_submodules(TARGET_MATRIX[tg]["libc"] for tg in targets)
+    stages.append(Stage("submodules", lambda jobs, paths=paths: fetch_gitmodules(paths),
+                        deps=clone_deps["riscv-gnu-toolchain"]))
+    # With MULTILIB, the compilers are built for the multilib targets and the
+    # selected targets get wrappers
+    multilibs = {}
+    if MULTILIB:
+        groups = {}
+        for tg in targets:
+            groups.setdefault(TARGET_MATRIX[tg]["libc"], []).append(tg)
+        for libc, group in groups.items():
+            ml = multilib_target(libc, group)
+            multilibs.update((tg, ml) for tg in group)
+    builds = sorted(set(multilibs.values())) if MULTILIB else targets
+    # Targets restored from the artifact cache skip their build stages
+    restored = set()
+    sources = []
+    for tg in builds:
+        if target_source(tg) not in sources:
+            sources.append(target_source(tg))
+    for source in sources:
+        paths = profile_submodules(TARGET_MATRIX[tg]["libc"] for tg in builds if source == target_source(tg))
+        stages.append(Stage("worktree-" + source, lambda jobs, source=source, paths=paths: update_gitmodules(source, paths),
+                            deps=["submodules"], locks=["riscv-gnu-toolchain"]))
+    for tg in builds:
+        stages.append(Stage("cache-" + tg, lambda jobs, tg=tg: restore_target(tg, restored),
+                            deps=["worktree-" + target_source(tg)] + clone_deps["riscv-pk"] + clone_deps["riscv-isa-sim"]))
+        stages.append(Stage("prefix-" + tg, lambda jobs, tg=tg: tg in restored or clean_prefix(tg),
+                            deps=["cache-" + tg]))
+        stages.append(Stage("toolchain-" + tg, lambda jobs, tg=tg: tg in restored or build_gnu_toolchain(tg, jobs),
+                            deps=["prefix-" + tg]))
+    for tg, ml in multilibs.items():
+        stages.append(Stage("prefix-" + tg, lambda jobs, tg=tg: clean_prefix(tg, wrappers=True), deps=["cache-" + ml]))
+        stages.append(Stage("toolchain-" + tg, lambda jobs, tg=tg, ml=ml: multilib_wrappers(tg, ml),
+                            deps=["toolchain-" + ml, "prefix-" + tg]))
+    for ml in sorted(set(multilibs.values())):
+        stages.append(Stage("pack-" + ml, lambda jobs, ml=ml: ml in restored or pack_target(ml, jobs),
+                            deps=["toolchain-" + ml]))
+
+    # Shared builds are skipped when every target using them was restored
+    def unless_restored(group, build):
+        return lambda jobs: all(tg in restored for tg in group) or build(jobs)
+
+    def cache_deps(group):
+        return sorted(set("cache-" + multilibs.get(tg, tg) for tg in group))
+
+    pk_groups = {}
+    spike_groups = {}
+    if spike:
+        for tg in targets:
+            pk_groups.setdefault(target_triple(tg), []).append(tg)
+            spike_groups.setdefault(install_root(tg), []).append(tg)
+    for triple, group in pk_groups.items():
+        cc = pk_compiler(group)
+        stages.append(Stage("pk-" + triple,
+                            unless_restored(group, lambda jobs, triple=triple, tg=cc: build_riscv_pk(triple, tg, jobs)),
+                            deps=["toolchain-" + cc] + cache_deps(group)))
+    for root, group in spike_groups.items():
+        stages.append(Stage("spike-" + os.path.basename(root),
+                            unless_restored(group, lambda jobs, root=root: build_riscv_spike(root, jobs)),
+                            deps=cache_deps(group)))
 
     for tg in targets:
-        INSTALL_PATH = RISCV_INSTALL + '/' + tg
-        if "elf" == tg:
-            GCC_BRANCH = "cd riscv-gcc && git reset --hard origin/riscv-gcc-12.1.0 && cd .."
-            TOOLCHAIN_CONFIG_CMD = "../configure --prefix=" + INSTALL_PATH
-            TOOLCHAIN_MAKE_CMD = "make -j" + NUM_CORES
-            PK_CONFIG_CMD = "../configure --host=riscv64-unknown-elf CC=riscv64-unknown-elf-gcc --prefix="+INSTALL_PATH
-        elif "elf-rvv" == tg:
-            GCC_BRANCH = "cd riscv-gcc && git reset --hard origin/riscv-gcc-rvv-next && cd .."
-            TOOLCHAIN_CONFIG_CMD = "../configure --with-arch=rv64gcv --with-abi=lp64d --prefix=" + INSTALL_PATH
-            TOOLCHAIN_MAKE_CMD = "make -j" + NUM_CORES
-            PK_CONFIG_CMD = "../configure --host=riscv64-unknown-elf CC=riscv64-unknown-elf-gcc --prefix="+INSTALL_PATH
-        elif "linux" == tg:
-            GCC_BRANCH = "cd riscv-gcc && git reset --hard origin/riscv-gcc-12.1.0 && cd .."
-            TOOLCHAIN_CONFIG_CMD = "../configure --prefix=" + INSTALL_PATH
-            TOOLCHAIN_MAKE_CMD = "make linux -j" + NUM_CORES
-            PK_CONFIG_CMD = "../configure --host=riscv64-unknown-linux-gnu CC=riscv64-unknown-linux-gnu-gcc --prefix="+INSTALL_PATH
-        elif "linux-rvv" == tg:
-            GCC_BRANCH = "cd riscv-gcc && git reset --hard origin/riscv-gcc-rvv-next && cd .."
-            TOOLCHAIN_CONFIG_CMD = "../configure --with-arch=rv64gcv --with-abi=lp64d --prefix=" + INSTALL_PATH
-            TOOLCHAIN_MAKE_CMD = "make linux -j" + NUM_CORES
-            PK_CONFIG_CMD = "../configure --host=riscv64-unknown-linux-gnu CC=riscv64-unknown-linux-gnu-gcc --prefix="+INSTALL_PATH
-        else:
-            print("Invalid target!")
+        triple = target_triple(tg)
+        installs = []
+        if spike:
+            root = install_root(tg)
+            stages.append(Stage("install-pk-" + tg,
+                                lambda jobs, tg=tg, triple=triple: (tg in restored or install_shared(
+                                    pk_build_dir(triple), tg, pk_build_env(tg))) and install_root_pk(tg),
+                                deps=["pk-" + triple, "prefix-" + tg, "toolchain-" + tg], locks=["riscv-pk"]))
+            stages.append(Stage("install-spike-" + tg,
+                                lambda jobs, tg=tg, root=root: tg in restored or install_shared(spike_build_dir(root), tg),
+                                deps=["spike-" + os.path.basename(root), "prefix-" + tg],
+                                locks=["riscv-isa-sim"]))
+            installs = ["install-pk-" + tg, "install-spike-" + tg]
+        # The prefixes of wrappers are not cached, their compiler is
+        stages.append(Stage("pack-" + tg, lambda jobs, tg=tg: tg in restored or tg in multilibs or pack_target(tg, jobs),
+                            deps=["toolchain-" + tg] + installs))
+    if SLIM_AFTER_BUILD:
+        stages.append(Stage("slim", lambda jobs: slim_prefixes(installed_targets(), jobs),
+                            deps=["pack-" + tg for tg in targets]))
+    print("[plan] " + str(len(targets)) + " targets: " + str(len(sources)) + " sources (" + ", ".join(sources) +
+          "), " + str(len(builds)) + " compilers" + (" (" + ", ".join(TARGET_MATRIX[ml]["prefix"] + ": " +
+          " ".join(TARGET_MATRIX[ml]["multilib"]) for ml in builds) + ")" if MULTILIB else "") +
+          ", " + str(len(pk_groups)) + " pk builds, " + str(len(spike_groups)) + " spike builds, profile " + BUILD_PROFILE)
+    return stages
+
+
+def build_gnu_tools(targets):
+    if not targets:
+        return True
+    return run_stages(gnu_stages(targets))
+
+
+def installed_targets():
+    return [tg for tg in TARGET_MATRIX if os.path.isdir(target_prefix(tg) + "/bin")]
+
+
+def prefix_files(prefixes):
+    for prefix in prefixes:
+        for root, _, files in os.walk(prefix):
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode):
+                    yield path, st
+
+
+def prefix_usage(prefixes):
+    # Bytes on disk, files linked several times count once
+    seen = set()
+    total = 0
+    for _, st in prefix_files(prefixes):
+        if (st.st_dev, st.st_ino) not in seen:
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+
+def elf_machine(path):
+    # (e_type, e_machine) of an ELF file, None for anything else
+    try:
+        with open(path, "rb") as f:
+            head = f.read(20)
+    except OSError:
+        return None
+    if len(head) < 20 or head[:4] != b"\x7fELF":
+        return None
+    order = "little" if 1 == head[5] else "big"
+    return int.from_bytes(head[16:18], order), int.from_bytes(head[18:20], order)
+
+
+def strip_prefixes(prefixes):
+    # Host executables and shared libraries only, the RISC-V libraries and
+    # objects in the sysroot are left alone. binutils and gcc install tools
+    # under several hardlinked names, so each inode is stripped once in a
+    # copy, which then replaces all of its names.
+    host = elf_machine(os.path.realpath(sys.executable))[1]
+    inodes = {}
+    for path, st in prefix_files(prefixes):
+        inodes.setdefault((st.st_dev, st.st_ino), []).append(path)
+    names = []
+    for paths in inodes.values():
+        elf = elf_machine(paths[0])
+        if elf and elf[0] in [2, 3] and host == elf[1]:
+            names.append(paths)
+    copies = [paths[0] + ".slim-strip" for paths in names]
+    for paths, copy in zip(names, copies):
+        shutil.copy2(paths[0], copy)
+    for i in range(0, len(copies), 200):
+        if not run("strip --strip-unneeded " + " ".join(shlex.quote(p) for p in copies[i:i + 200])):
+            # strip leaves the files it cannot handle as they are
+            print("[slim] some files could not be stripped")
+    for paths, copy in zip(names, copies):
+        # Stripped by an earlier pass, or not strippable
+        if os.path.getsize(copy) != os.path.getsize(paths[0]):
+            for path in paths:
+                os.link(copy, path + ".slim-tmp")
+                os.replace(path + ".slim-tmp", path)
+        os.remove(copy)
+
+
+def dedupe_prefixes(prefixes, jobs=1):
+    # Hardlink files with the same content, mode and owner on the same file
+    # system. Only sizes seen more than once are hashed.
+    by_size = {}
+    for path, st in prefix_files(prefixes):
+        if st.st_size:
+            by_size.setdefault((st.st_dev, st.st_size, st.st_mode, st.st_uid, st.st_gid), []).append((path, st))
+    candidates = [f for group in by_size.values() if len(group) > 1 for f in group]
+    with ThreadPoolExecutor(max(1, jobs)) as pool:
+        hashes = list(pool.map(lambda f: file_sha256(f[0]), candidates))
+    first = {}
+    linked = 0
+    for (path, st), digest in zip(candidates, hashes):
+        key = (st.st_dev, st.st_mode, st.st_uid, st.st_gid, digest)
+        if key not in first:
+            first[key] = (path, st)
             continue
+        src, src_st = first[key]
+        if (src_st.st_dev, src_st.st_ino) == (st.st_dev, st.st_ino):
+            continue
+        tmp = path + ".slim-tmp"
+        os.link(src, tmp)
+        os.replace(tmp, path)
+        linked += 1
+    return linked
+
+
+def unshare_prefix(prefix):
+    # Copy back the files of prefix linked with other prefixes, so writing to
+    # them changes only this prefix
+    for path, st in list(prefix_files([prefix])):
+        if st.st_nlink > 1:
+            tmp = path + ".slim-tmp"
+            shutil.copy2(path, tmp)
+            os.replace(tmp, path)
+
+
+def check_toolchain(tg):
+    # The compiler, assembler, linker and C library of tg still work
+    prefix = target_prefix(tg)
+    gcc = os.path.join(prefix, "bin", target_triple(tg) + "-gcc")
+    if not run("echo 'int main(void) { return 0; }' | " + gcc + " -x c -o /dev/null -", WORK_DIR):
+        return False
+    # Multilib compilers and prefixes built without spike have no spike
+    spike = os.path.join(prefix, "bin", "spike")
+    return "multilib" in TARGET_MATRIX[tg] or not os.path.exists(spike) or \
+        run(spike + " --help >/dev/null 2>&1 || test $? -eq 1", WORK_DIR)
+
 
-        update_gitmodules(tg)
-
-        if os.path.exists(INSTALL_PATH):
-            os.system("rm -rf " + INSTALL_PATH)
-        # install riscv-gnu-toolchain
-        os.chdir("riscv-gnu-toolchain")
-        os.system(GCC_BRANCH)
-        remkdir_cd_build()
-        os.system(TOOLCHAIN_CONFIG_CMD)
-        os.system(TOOLCHAIN_MAKE_CMD)
-        os.chdir("../..")
-
-        # install riscv-pk
-        os.chdir("riscv-pk")
-        remkdir_cd_build()
-        os.environ["PATH"] = INSTALL_PATH + "/bin:" + ENV_PATH
-        os.system(PK_CONFIG_CMD)
-        os.system("make -j48 && make install")
-        os.chdir("../..")
-
-        # install riscv-isa-sim (spike)
-        os.chdir("riscv-isa-sim")
-        remkdir_cd_build()
-        os.system("../configure --prefix=" + INSTALL_PATH)
-        os.system("make -j48 && make install")
-        os.chdir("../..")
+def slim_prefixes(targets, jobs=1):
+    prefixes = [target_prefix(tg) for tg in targets]
+    if not prefixes:
+        print("[slim] no installed targets")
+        return True
+    before = prefix_usage(prefixes)
+    if STRIP_BINARIES:
+        strip_prefixes(prefixes)
+    stripped = prefix_usage(prefixes)
+    linked = dedupe_prefixes(prefixes, jobs)
+    after = prefix_usage(prefixes)
+    print("[slim] %s: %d MB -> %d MB, strip saved %d MB, %d files linked saved %d MB" % (
+        " ".join(targets), before >> 20, after >> 20, (before - stripped) >> 20, linked, (stripped - after) >> 20))
+    ok = True
+    for tg in targets:
+        if not check_toolchain(tg):
+            print("[slim] " + tg + " does not work anymore")
+            ok = False
+    return ok
+
+
+def checkout_llvm(clone=False):
+    if clone and not clone_repo(LLVM_REPO):
+        return False
+    return run("git checkout origin/" + LLVM_BRANCH, os.path.join(WORK_DIR, "llvm-project"))
 
 
 def clone_llvm_repo(auto=False):
-    opt_clone_repo = 'N'
-    if not auto:
-        opt_clone_repo = input("Re-clone llvm-project repo? (y/[N]) >>> ")
-    else:
-        opt_clone_repo = 'y'
+    clone = ask_clone("Clone or update llvm-project repo? (y/[N]) >>> ", auto)
+    return checkout_llvm(clone)
+
+
+LLVM_CCACHE_FLAGS = " -DCMAKE_C_COMPILER_LAUNCHER=ccache -DCMAKE_CXX_COMPILER_LAUNCHER=ccache"
 
-    if opt_clone_repo in ['y', 'Y']:
-        if os.path.exists("llvm-project"):
-            os.system("rm -rf llvm-project")
-        os.system("git clone " + LLVM_REPO)
+
+def llvm_linker(profile):
+    for name in profile["linkers"]:
+        if not shutil.which("ld." + name):
+            continue
+        # gcc only understands -fuse-ld=mold from version 12 on
+        if "mold" == name and int((cmd_output("gcc -dumpversion", WORK_DIR) or "0").split(".")[0]) < 12:
+            continue
+        return name
+    return None
+
+
+def llvm_cmake_cmd(name=LLVM_PROFILE, prefix="../install"):
+    profile = LLVM_PROFILES[name]
+    cmd = 'cmake -G "' + LLVM_BUILD_TOOL + '" -DCMAKE_C_COMPILER=`which gcc` -DCMAKE_CXX_COMPILER=`which g++` -DCMAKE_ASM_COMPILER=`which gcc` -DCMAKE_BUILD_TYPE=' + profile["build_type"] + ' -DCMAKE_INSTALL_PREFIX=' + prefix + ' -DLLVM_TARGETS_TO_BUILD="RISCV" -DLLVM_ENABLE_PROJECTS="' + profile["projects"] + '"'
+    linker = llvm_linker(profile)
+    if linker:
+        cmd += " -DLLVM_USE_LINKER=" + linker
+    if profile.get("split_dwarf"):
+        cmd += " -DLLVM_USE_SPLIT_DWARF=ON -DLLVM_OPTIMIZED_TABLEGEN=ON"
+    if profile.get("distribution"):
+        cmd += ' -DLLVM_DISTRIBUTION_COMPONENTS="' + ";".join(profile["distribution"]) + '"'
+    if USE_CCACHE:
+        cmd += LLVM_CCACHE_FLAGS
+    return cmd + " ../llvm"
+
+
+def llvm_make_cmd(name, jobs):
+    profile = LLVM_PROFILES[name]
+    if profile.get("distribution"):
+        make = LLVM_BUILD_BIN + " -j" + str(jobs) + " distribution && " + LLVM_BUILD_BIN + " install-distribution"
     else:
-        print("Skip cloning llvm-project...")
-    os.system("cd llvm-project && git checkout origin/release/15.x && cd ..")
+        make = LLVM_BUILD_BIN + " -j" + str(jobs) + " && " + LLVM_BUILD_BIN + " install"
+    if "Ninja" == LLVM_BUILD_TOOL:
+        # Set on the existing cache so a different limit does not count as
+        # a configuration change
+        make = "cmake -DLLVM_PARALLEL_LINK_JOBS=" + str(link_jobs(profile["link_memory_gb"])) + " . && " + make
+    return make
+
+
+def build_llvm(jobs=None):
+    src = os.path.join(WORK_DIR, "llvm-project")
+    jobs = jobs or compile_jobs()
+    env = ccache_stats_env("llvm", dict(os.environ, CCACHE_DIR=CCACHE_DIR, CCACHE_MAXSIZE=CCACHE_MAXSIZE))
+    # Installed next to the build directory, on disk also when it is on scratch
+    os.makedirs(src + "/install", exist_ok=True)
+    if not build_configured("llvm", src, "build", llvm_cmake_cmd(), llvm_make_cmd(LLVM_PROFILE, jobs),
+                            src + "/install/bin/clang", env, LLVM_PROFILES[LLVM_PROFILE]["build_gb"]):
+        return False
+    release_scratch(src + "/build")
+    return True
+
+
+def clang_link_time(build):
+    # Seconds ninja spent on the clang binary (bin/clang-<major>), from .ninja_log
+    path = os.path.join(build, ".ninja_log")
+    if not os.path.exists(path):
+        return None
+    link = None
+    with open(path) as f:
+        for line in f:
+            fields = line.split("\t")
+            if 5 == len(fields) and "bin/clang-" in fields[3] and fields[3].rsplit("-", 1)[-1].isdigit():
+                link = (int(fields[1]) - int(fields[0])) / 1000.0
+    return link
+
+
+def benchmark_llvm(names):
+    # Build each profile from scratch next to the regular build, with ccache
+    # disabled so that every profile compiles everything
+    src = os.path.join(WORK_DIR, "llvm-project")
+    env = dict(os.environ, CCACHE_DISABLE="1")
+    jobs = compile_jobs()
+    results = []
+    for name in names:
+        build = remkdir_build(src, "build-bench-" + name, LLVM_PROFILES[name]["build_gb"])
+        first = len(STEP_RECORDS)
+        ok = run_all([llvm_cmake_cmd(name, build + "/install"), llvm_make_cmd(name, jobs)], build, env)
+        steps = STEP_RECORDS[first:]
+        results.append({"profile": name, "ok": ok, "linker": llvm_linker(LLVM_PROFILES[name]) or "default",
+                        "wall": sum(st["wall"] for st in steps), "cpu": sum(st["cpu"] for st in steps),
+                        "max_rss_kb": max(st["max_rss_kb"] for st in steps),
+                        "clang_link": clang_link_time(build), "install_bytes": dir_size(build + "/install")})
+        release_scratch(build)
+        run("rm -rf " + build)
+
+    with open(LLVM_BENCHMARK_PATH, "w") as f:
+        json.dump({"jobs": jobs, "link_jobs": dict((n, link_jobs(LLVM_PROFILES[n]["link_memory_gb"])) for n in names),
+                   "results": results}, f, indent=1)
+    base = results[0]["wall"] if results and results[0]["ok"] else None
+    print("%-8s %-8s %10s %10s %8s %10s %10s" % ("profile", "linker", "wall", "clang link", "speedup",
+                                                "peak RSS", "installed"))
+    for r in results:
+        print("%-8s %-8s %10s %10s %8s %8dMB %8dMB" % (
+            r["profile"], r["linker"], fmt_time(r["wall"]) if r["ok"] else "failed",
+            "%.1fs" % r["clang_link"] if r["clang_link"] is not None else "-",
+            "%.2fx" % (base / r["wall"]) if base and r["ok"] else "-",
+            r["max_rss_kb"] // 1024, r["install_bytes"] >> 20))
+    print("Benchmark written to " + LLVM_BENCHMARK_PATH)
+    return all(r["ok"] for r in results)
+
+
+def llvm_artifact():
+    stamps = {"llvm": stage_stamp(os.path.join(WORK_DIR, "llvm-project"), llvm_cmake_cmd())}
+    return artifact_key(stamps), {"prefix": os.path.join(WORK_DIR, "llvm-project", "install"), "stamps": stamps}
+
+
+def restore_llvm(restored):
+    src = os.path.join(WORK_DIR, "llvm-project")
+    key, info = llvm_artifact()
+    if restore_artifact("cache-llvm", key, src + "/install", {src + "/build": info["stamps"]["llvm"]},
+                        src + "/install/bin/clang"):
+        restored.add("llvm")
+    return True
+
+
+def pack_llvm(jobs):
+    key, info = llvm_artifact()
+    return pack_artifact("pack-llvm", key, info["prefix"], info, jobs)
+
+
+def llvm_stages(clone=False):
+    restored = set()
+    return [Stage("source-llvm", lambda jobs: checkout_llvm(clone)),
+            Stage("cache-llvm", lambda jobs: restore_llvm(restored), deps=["source-llvm"]),
+            Stage("llvm", lambda jobs: "llvm" in restored or build_llvm(jobs), deps=["cache-llvm"]),
+            Stage("pack-llvm", lambda jobs: "llvm" in restored or pack_llvm(jobs), deps=["llvm"])]
+
+
+
+def bundle_pins():
+    # {url: {ref: sha}} of the revisions the build checks out: the branches
+    # of the top-level repos, and for every TOOLCHAIN_SOURCES entry the
+    # submodule commits and the riscv-gcc branch it resets to
+    main = os.path.join(WORK_DIR, "riscv-gnu-toolchain")
+    pins = {}
+    for repo in RISCV_REPOS + [LLVM_REPO]:
+        src = os.path.join(WORK_DIR, repo_dir(repo))
+        if "riscv-gnu-toolchain" == repo_dir(repo):
+            branches = sorted(set(spec["branch"] for spec in TOOLCHAIN_SOURCES.values()))
+        elif LLVM_REPO == repo:
+            branches = [LLVM_BRANCH]
+        else:
+            head = cmd_output("git symbolic-ref --short refs/remotes/origin/HEAD", src)
+            branches = [head.split("/", 1)[1]] if head else []
+        pins[repo] = {}
+        for branch in branches:
+            sha = cmd_output("git rev-parse --verify -q origin/" + branch + "^{commit}", src)
+            if not sha:
+                print("[bundle] " + src + " has no origin/" + branch + ", clone or update it first")
+                return None
+            pins[repo]["refs/heads/" + branch] = sha
+        if branches:
+            pins[repo]["HEAD"] = "refs/heads/" + branches[0]
+
+    # The submodules BUILD_PROFILE checks out for any target
+    paths = profile_submodules(spec["libc"] for spec in TARGET_MATRIX.values())
+    for source, spec in TOOLCHAIN_SOURCES.items():
+        rev = "origin/" + spec["branch"]
+        if spec["gitmodules"]:
+            config = os.path.join(WORK_DIR, ".gitmodules-" + source)
+            with open(config, "w") as f:
+                f.write(spec["gitmodules"])
+            modules = gitmodules(main, "-f " + config)
+            os.remove(config)
+        else:
+            modules = gitmodules(main, "--blob " + rev + ":.gitmodules")
+        for _, path, url in modules:
+            if "qemu" == path or (paths is not None and path not in paths):
+                continue
+            sha = cmd_output("git rev-parse " + rev + ":" + path, main)
+            if not sha:
+                continue
+            pins.setdefault(url, {})["refs/pinned/" + sha] = sha
+            if "riscv-gcc" == path:
+                gcc = resolve_branch(url, spec["gcc"], os.path.join(main, path))
+                if not gcc:
+                    print("[bundle] cannot resolve " + spec["gcc"] + " of " + url)
+                    return None
+                pins[url]["refs/heads/" + spec["gcc"]] = gcc
+    return pins
+
+
+def resolve_branch(url, branch, checkout):
+    # sha of a branch of url, from the mirror, a checkout or the network
+    for src, ref in [(mirror_path(url), "refs/heads/" + branch), (checkout, "origin/" + branch)]:
+        if os.path.exists(src):
+            sha = cmd_output("git rev-parse --verify -q " + ref + "^{commit}", src)
+            if sha:
+                return sha
+    out = cmd_output("git ls-remote " + url + " refs/heads/" + branch, WORK_DIR)
+    return out.split()[0] if out else None
+
+
+def bundle_sources(url):
+    # Local repositories that may hold the pinned commits of url, then url
+    name = repo_dir(url)
+    srcs = [mirror_path(url), os.path.join(WORK_DIR, name)]
+    main = os.path.join(WORK_DIR, "riscv-gnu-toolchain")
+    for _, path, module_url in gitmodules(main):
+        if module_url == url:
+            srcs.append(os.path.join(main, path))
+    if os.path.isdir(WORKTREE_DIR):
+        for wt in sorted(os.listdir(WORKTREE_DIR)):
+            for _, path, module_url in gitmodules(os.path.join(WORKTREE_DIR, wt)):
+                if module_url == url:
+                    srcs.append(os.path.join(WORKTREE_DIR, wt, path))
+    return [src for src in srcs if os.path.exists(src)] + [url]
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def export_bundle(out):
+    # One depth-1 bundle per repo or submodule url with its pinned commits,
+    # and a manifest to restore them as mirrors
+    pins = bundle_pins()
+    if not pins:
+        return False
+    os.makedirs(out, exist_ok=True)
+    manifest = {"created": time.strftime("%Y-%m-%d %H:%M:%S"), "repos": {}}
+    for url, refs in sorted(pins.items()):
+        key = os.path.basename(mirror_path(url))[:-len(".git")]
+        tmp = os.path.join(out, key + ".tmp")
+        shas = " ".join(sorted(set(sha for ref, sha in refs.items() if "HEAD" != ref)))
+        run("rm -rf " + tmp + " && git init -q --bare " + tmp)
+        fetch = "git -c protocol.file.allow=always -c uploadpack.allowAnySHA1InWant=true fetch -q --depth 1 "
+        if not any(run(fetch + src + " " + shas, tmp) for src in bundle_sources(url)):
+            print("[bundle] could not fetch the pinned commits of " + url)
+            return False
+        cmds = ["git update-ref " + ref + " " + sha for ref, sha in sorted(refs.items()) if "HEAD" != ref]
+        bundle = os.path.join(out, key + ".bundle")
+        if not run_all(cmds + ["git bundle create -q " + bundle + " --all"], tmp):
+            return False
+        with open(os.path.join(tmp, "shallow")) as f:
+            shallow = f.read().split()
+        manifest["repos"][url] = {"bundle": key + ".bundle", "refs": refs, "shallow": shallow,
+                                  "sha256": file_sha256(bundle), "bytes": os.path.getsize(bundle)}
+        run("rm -rf " + tmp)
+    with open(os.path.join(out, BUNDLE_MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    total = sum(r["bytes"] for r in manifest["repos"].values())
+    print("Exported %d repos (%d MB) to %s" % (len(manifest["repos"]), total >> 20, out))
+    return True
+
+
+def import_bundle(src):
+    # Restore the bundles of src as (shallow) mirrors in MIRROR_DIR
+    with open(os.path.join(src, BUNDLE_MANIFEST)) as f:
+        manifest = json.load(f)
+    os.makedirs(MIRROR_DIR, exist_ok=True)
+    for url, entry in sorted(manifest["repos"].items()):
+        bundle = os.path.join(src, entry["bundle"])
+        if file_sha256(bundle) != entry["sha256"]:
+            print("[bundle] " + bundle + " is corrupt")
+            return False
+        path = mirror_path(url)
+        with open(path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            run("rm -rf " + path + " && git init -q --bare " + path)
+            with open(os.path.join(path, "shallow"), "w") as f:
+                f.write("".join(sha + "\n" for sha in entry["shallow"]))
+            cmds = ["git bundle unbundle " + bundle + " > /dev/null"]
+            cmds += ["git update-ref " + ref + " " + sha for ref, sha in sorted(entry["refs"].items()) if "HEAD" != ref]
+            if "HEAD" in entry["refs"]:
+                cmds.append("git symbolic-ref HEAD " + entry["refs"]["HEAD"])
+            # Submodule commits are fetched by sha, they are not branch tips
+            cmds += ["git config remote.origin.url " + url, "git config remote.origin.mirror true",
+                     "git config remote.origin.fetch '+refs/*:refs/*'", "git config uploadpack.allowAnySHA1InWant true"]
+            if not run_all(cmds, path):
+                return False
+    print("Imported %d repos into %s, build with --offline" % (len(manifest["repos"]), MIRROR_DIR))
+    return True
+
+
+def prefix_manifest(prefix, jobs=1):
+    # {path: entry} of the directories, symlinks and files (with their
+    # sha256) in prefix
+    entries = {}
+    for root, dirs, files in os.walk(prefix):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            rel = os.path.relpath(path, prefix)
+            if stat.S_ISLNK(st.st_mode):
+                entries[rel] = {"type": "link", "target": os.readlink(path)}
+            elif stat.S_ISDIR(st.st_mode):
+                entries[rel] = {"type": "dir", "mode": stat.S_IMODE(st.st_mode)}
+            elif stat.S_ISREG(st.st_mode):
+                entries[rel] = {"type": "file", "mode": stat.S_IMODE(st.st_mode), "size": st.st_size}
+    files = sorted(rel for rel in entries if "file" == entries[rel]["type"])
+    with ThreadPoolExecutor(max(1, jobs)) as pool:
+        for rel, digest in zip(files, pool.map(lambda rel: file_sha256(os.path.join(prefix, rel)), files)):
+            entries[rel]["sha256"] = digest
+    return entries
+
+
+def manifest_key(manifest):
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+
+
+def delta_source(path, tmp):
+    # A prefix, or an archive of the artifact cache extracted into tmp
+    if os.path.isdir(path):
+        return path
+    os.makedirs(tmp)
+    if not run("tar " + tar_compress_opt(path) + " -xf " + path + " -C " + tmp):
+        return None
+    return os.path.join(tmp, os.listdir(tmp)[0])
+
+
+def delta_base(rel, entry, old, by_name, by_sha):
+    # The old file a new file is made from: one with the same content, the
+    # same path, or the same name and the closest size (gcc's version
+    # directories change with every release)
+    same = by_sha.get(entry["sha256"])
+    if same:
+        return same, "copy"
+    if "file" == old.get(rel, {}).get("type"):
+        return rel, "patch"
+    named = by_name.get(os.path.basename(rel))
+    if named:
+        return min(named, key=lambda o: abs(old[o]["size"] - entry["size"])), "patch"
+    return None, "full"
+
+
+def make_delta(old_path, new_path, out):
+    jobs = compile_jobs()
+    tmp = out + ".tmp"
+    run("rm -rf " + tmp)
+    old_path = delta_source(old_path, tmp + "/old")
+    new_path = delta_source(new_path, tmp + "/new")
+    if not old_path or not new_path:
+        return False
+    old, new = prefix_manifest(old_path, jobs), prefix_manifest(new_path, jobs)
+    by_name, by_sha = {}, {}
+    for rel in sorted(old):
+        if "file" == old[rel]["type"]:
+            by_name.setdefault(os.path.basename(rel), []).append(rel)
+            by_sha.setdefault(old[rel]["sha256"], rel)
+    stage = os.path.join(tmp, "delta")
+    os.makedirs(stage + "/data")
+
+    def pack(item):
+        i, rel = item
+        entry = new[rel]
+        if old.get(rel, {}).get("sha256") == entry["sha256"]:
+            return dict(entry, method="keep")
+        base, method = delta_base(rel, entry, old, by_name, by_sha)
+        res = dict(entry, method=method, base=base)
+        if "copy" == method:
+            return res
+        res["data"] = "data/" + str(i)
+        cmd = "zstd -q -19 --long=31 " + shlex.quote(os.path.join(new_path, rel)) + " -o " + os.path.join(stage, res["data"])
+        if "patch" == method:
+            res["base_sha256"] = old[base]["sha256"]
+            cmd += " --patch-from=" + shlex.quote(os.path.join(old_path, base))
+        return res if run(cmd) else None
+
+    files = sorted(rel for rel in new if "file" == new[rel]["type"])
+    with ThreadPoolExecutor(jobs) as pool:
+        packed = dict(zip(files, pool.map(pack, enumerate(files))))
+    if None in packed.values():
+        return False
+    delta = {"base": manifest_key(old), "result": manifest_key(new), "files": packed,
+             "dirs": dict((rel, e["mode"]) for rel, e in new.items() if "dir" == e["type"]),
+             "links": dict((rel, e["target"]) for rel, e in new.items() if "link" == e["type"])}
+    with open(os.path.join(stage, DELTA_MANIFEST), "w") as f:
+        json.dump(delta, f, sort_keys=True)
+    if not run("tar -cf " + out + " -C " + stage + " ."):
+        return False
+    run("rm -rf " + tmp)
+    counts = dict((m, len([e for e in packed.values() if m == e["method"]])) for m in ["keep", "copy", "patch", "full"])
+    print("Delta %s -> %s written to %s: %d MB for a %d MB prefix (%d kept, %d moved, %d patched, %d new files)" % (
+        delta["base"][:12], delta["result"][:12], out, os.path.getsize(out) >> 20,
+        sum(e["size"] for e in packed.values()) >> 20, counts["keep"], counts["copy"], counts["patch"], counts["full"]))
+    return True
+
 
+def apply_delta(path, prefix):
+    # Build the new prefix next to the old one, from hardlinks of the files
+    # that did not change and the patched files, then swap them
+    prefix = os.path.abspath(prefix.rstrip("/"))
+    tmp = prefix + ".delta-tmp"
+    new_path = prefix + ".delta-new"
+    run("rm -rf " + tmp + " " + new_path)
+    os.makedirs(tmp)
+    if not run("tar -xf " + path + " -C " + tmp):
+        return False
+    with open(os.path.join(tmp, DELTA_MANIFEST)) as f:
+        delta = json.load(f)
+    # The kept, moved and patched files are only right on the exact base
+    base = manifest_key(prefix_manifest(prefix, compile_jobs()))
+    if base != delta["base"]:
+        print("[delta] " + prefix + " is " + base[:12] + ", the delta applies to " + delta["base"][:12])
+        run("rm -rf " + tmp)
+        return False
+    os.makedirs(new_path)
+    for rel in sorted(delta["dirs"]):
+        os.makedirs(os.path.join(new_path, rel), exist_ok=True)
+    for rel, target in delta["links"].items():
+        os.symlink(target, os.path.join(new_path, rel))
+
+    def place(rel):
+        entry = delta["files"][rel]
+        dest = os.path.join(new_path, rel)
+        src = os.path.join(prefix, entry.get("base") or rel)
+        if entry["method"] in ["keep", "copy"]:
+            if not os.path.isfile(src) or os.path.getsize(src) != entry["size"]:
+                print("[delta] " + src + " does not match the base prefix")
+                return False
+            if stat.S_IMODE(os.stat(src).st_mode) == entry["mode"]:
+                os.link(src, dest)
+                return True
+            shutil.copy(src, dest)
+        else:
+            if "patch" == entry["method"] and (not os.path.isfile(src) or file_sha256(src) != entry["base_sha256"]):
+                print("[delta] " + src + " does not match the base prefix")
+                return False
+            cmd = "zstd -q -d --long=31 " + os.path.join(tmp, entry["data"]) + " -o " + shlex.quote(dest)
+            if "patch" == entry["method"]:
+                cmd += " --patch-from=" + shlex.quote(src)
+            if not run(cmd) or file_sha256(dest) != entry["sha256"]:
+                print("[delta] " + dest + " has the wrong checksum")
+                return False
+        os.chmod(dest, entry["mode"])
+        return True
+
+    with ThreadPoolExecutor(compile_jobs()) as pool:
+        ok = all(list(pool.map(place, sorted(delta["files"]))))
+    if not ok:
+        run("rm -rf " + tmp + " " + new_path)
+        return False
+    for rel, mode in delta["dirs"].items():
+        os.chmod(os.path.join(new_path, rel), mode)
+    os.rename(prefix, tmp + "/old")
+    os.rename(new_path, prefix)
+    run("rm -rf " + tmp)
+    print("Updated %s to %s" % (prefix, delta["result"][:12]))
+    return True
+
+
+def remote_cmd(host, cmd):
+    name = host.rsplit(":", 1)[0]
+    if "local" == name:
+        return "sh -c " + shlex.quote(cmd)
+    return "ssh -o BatchMode=yes " + name + " " + shlex.quote(cmd)
+
+
+def host_cores(host):
+    out = cmd_output(remote_cmd(host, "nproc"), WORK_DIR)
+    return int(out) if out and out.isdigit() else 1
+
+
+def target_cost(tg):
+    return REMOTE_COSTS["llvm"] if "llvm" == tg else REMOTE_COSTS[TARGET_MATRIX[tg]["libc"]]
+
+
+def assign_targets(targets, hosts):
+    # Most expensive target first, to the host that finishes it soonest
+    with ThreadPoolExecutor(len(hosts)) as pool:
+        cores = dict(zip(hosts, pool.map(host_cores, hosts)))
+    load = dict((h, 0) for h in hosts)
+    plan = dict((h, []) for h in hosts)
+    for tg in sorted(targets, key=target_cost, reverse=True):
+        host = min(hosts, key=lambda h: (load[h] + target_cost(tg)) / float(cores[h]))
+        plan[host].append(tg)
+        load[host] += target_cost(tg)
+    for host in hosts:
+        print("[remote] " + host + " (" + str(cores[host]) + " cores): " + (" ".join(plan[host]) or "idle"))
+    return plan
+
+
+def installed_path(tg):
+    return os.path.join(WORK_DIR, "llvm-project", "install") if "llvm" == tg else target_prefix(tg)
 
-def build_llvm():
-    os.chdir("llvm-project")
-    remkdir_cd_build()
 
-    os.system('cmake -G "' + LLVM_BUILD_TOOL + '" -DCMAKE_C_COMPILER=`which gcc` -DCMAKE_CXX_COMPILER=`which g++` -DCMAKE_ASM_COMPILER=`which gcc` -DCMAKE_BUILD_TYPE=Release -DCMAKE_INSTALL_PREFIX=../install -DLLVM_TARGETS_TO_BUILD="RISCV" -DLLVM_ENABLE_PROJECTS="clang" ../llvm')
-    os.system(LLVM_BUILD_BIN + " -j" + NUM_CORES +
-              " && " + LLVM_BUILD_BIN + " install")
+def remote_done(host, targets):
+    # Targets whose stages all completed on host, from its journal
+    path = host.rsplit(":", 1)[1]
+    out = cmd_output(remote_cmd(host, "cat " + path + "/build_journal.json"), WORK_DIR)
+    stages = json.loads(out)["stages"] if out else {}
+    return [tg for tg in targets if "done" == stages.get("pack-" + tg)]
+
+
+def remote_build(host, targets):
+    path = host.rsplit(":", 1)[1]
+    script_dir, script = os.path.split(os.path.abspath(__file__))
+    env = "RISCV_BUILD_HOSTS="
+    for name in REMOTE_ENV:
+        if os.getenv(name):
+            env += " " + name + "=" + shlex.quote(os.getenv(name))
+    args = " --yes" + (" --offline" if OFFLINE else "") + (" --multilib" if MULTILIB else "") + \
+        " --profile=" + BUILD_PROFILE + (" --branch=" + shlex.quote(BRANCH) if BRANCH else "") + " " + " ".join(targets)
+    push = "tar -C " + script_dir + " -cf - " + script + " | " + remote_cmd(host, "mkdir -p " + path + " && tar -C " + path + " -xf -")
+    build = remote_cmd(host, "cd " + path + " && env " + env + " " + REMOTE_PYTHON + " " + script + args)
+    ok = run(push) and run(build)
+    # Whatever completed is copied back, also when other targets failed
+    done = targets if ok else remote_done(host, targets)
+    for tg in done:
+        local = installed_path(tg)
+        parent, name = os.path.split(os.path.relpath(local, WORK_DIR))
+        pull = remote_cmd(host, "tar -C " + os.path.join(path, parent) + " -cf - " + name)
+        if not run("rm -rf " + local + " && mkdir -p " + os.path.dirname(local) + " && " + pull +
+                   " | tar -C " + os.path.dirname(local) + " -xf -"):
+            return False
+    return ok
+
+
+def remote_stages(targets, hosts=None):
+    # One stage per host building all the targets it was given
+    hosts = hosts or BUILD_HOSTS
+    plan = assign_targets([tg for tg in targets if "llvm" == tg or tg in TARGET_MATRIX], hosts)
+    return [Stage("remote-" + str(i) + "-" + host.rsplit(":", 1)[0].split("@")[-1],
+                  lambda jobs, host=host: remote_build(host, plan[host]), kind="remote")
+            for i, host in enumerate(hosts) if plan[host]]
+
+
+def bench_compiler(config):
+    tg = config["target"]
+    triple = target_triple(tg)
+    if "clang" == config["cc"]:
+        return (os.path.join(WORK_DIR, "llvm-project", "install", "bin", "clang") + " --target=" + triple +
+                " --gcc-toolchain=" + target_prefix(tg))
+    return os.path.join(target_prefix(tg), "bin", triple + "-gcc")
+
+
+def bench_runner(config):
+    # spike and pk installed in the prefix of the target
+    tg = config["target"]
+    spec = TARGET_MATRIX[tg]
+    prefix = target_prefix(tg)
+    return (os.path.join(prefix, "bin", "spike") + " --isa=" + spec.get("arch", "rv" + str(spec["xlen"]) + "gc") +
+            " " + os.path.join(prefix, target_triple(tg), "bin", "pk"))
+
+
+def bench_programs():
+    return sorted(f[:-2] for f in os.listdir(BENCH_DIR) if f.endswith(".c"))
+
+
+def run_bench_config(name, results):
+    config = BENCH_CONFIGS[name]
+    out_dir = os.path.join(BENCH_BUILD_DIR, name)
+    run("rm -rf " + out_dir + " && mkdir -p " + out_dir)
+    ok = True
+    for prog in bench_programs():
+        exe = os.path.join(out_dir, prog)
+        res = {"config": name, "bench": prog, "ok": False}
+        results.append(res)
+        if not run(bench_compiler(config) + " " + config["cflags"] + " -o " + exe + " " +
+                   os.path.join(BENCH_DIR, prog + ".c"), BENCH_DIR):
+            ok = False
+            continue
+        start = time.time()
+        try:
+            proc = subprocess.run(bench_runner(config) + " " + exe, shell=True, stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT, universal_newlines=True, timeout=BENCH_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            print("[bench-" + name + "] " + prog + " timed out")
+            ok = False
+            continue
+        res["seconds"] = time.time() - start
+        line = [ln for ln in proc.stdout.splitlines() if ln.startswith("BENCH ")]
+        if proc.returncode or not line:
+            print("[bench-" + name + "] " + prog + " failed:\n" + proc.stdout)
+            ok = False
+            continue
+        fields = dict(f.split("=") for f in line[-1].split()[1:])
+        res.update(ok=True, cycles=int(fields["cycles"]), instret=int(fields["instret"]), check=fields["check"])
+    return ok
+
+
+def bench_stages(names, results):
+    return [Stage("bench-" + name, lambda jobs, name=name: run_bench_config(name, results), kind="bench")
+            for name in names]
+
+
+def bench_versions(names):
+    versions = {}
+    for name in names:
+        cc = bench_compiler(BENCH_CONFIGS[name]).split()[0]
+        versions[name] = cmd_output(cc + " --version | head -1", WORK_DIR)
+    return versions
+
+
+def benchmark_toolchains(names):
+    # Compile and run the benchmarks with every configuration whose toolchain
+    # is installed, then compare them and the previous report
+    ready = []
+    for name in names:
+        config = BENCH_CONFIGS[name]
+        tools = [bench_compiler(config).split()[0]] + bench_runner(config).split()[::2]
+        missing = [t for t in tools if not os.path.exists(t)]
+        if missing:
+            print("[bench] " + name + " skipped, not installed: " + " ".join(missing))
+        else:
+            ready.append(name)
+    if not ready:
+        return False
+    try:
+        with open(BENCH_REPORT_PATH) as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = None
+    results = []
+    ok = run_stages(bench_stages(ready, results))
+    versions = bench_versions(ready)
+    configs = dict((n, dict(BENCH_CONFIGS[n], compiler=versions[n])) for n in ready)
+    kept = []
+    if previous:
+        # The configurations not run this time keep their last results
+        configs = dict(((n, c) for n, c in previous["configs"].items() if n not in ready), **configs)
+        kept = [r for r in previous["results"] if r["config"] not in ready]
+    with open(BENCH_REPORT_PATH, "w") as f:
+        json.dump({"configs": configs, "results": kept + results}, f, indent=1)
+
+    by_key = dict(((r["config"], r["bench"]), r) for r in results if r["ok"])
+    print("instret (millions)")
+    print("%-10s" % "bench" + "".join(" %13s" % n for n in ready))
+    for prog in bench_programs():
+        cells = [by_key.get((n, prog)) for n in ready]
+        print("%-10s" % prog + "".join(" %13s" % ("%.2f" % (r["instret"] / 1e6) if r else "failed") for r in cells))
+        checks = set(r["check"] for r in cells if r)
+        if len(checks) > 1:
+            print("    check values differ: " + ", ".join(n + "=" + r["check"] for n, r in zip(ready, cells) if r))
+    if previous:
+        old = dict(((r["config"], r["bench"]), r) for r in previous["results"] if r["ok"])
+        for key in sorted(by_key):
+            if key in old and old[key]["instret"]:
+                change = by_key[key]["instret"] / float(old[key]["instret"]) - 1
+                if abs(change) > BENCH_THRESHOLD:
+                    print("    %s %s: instret %+.1f%% against the previous report (%s, was %s)" % (
+                        key[0], key[1], change * 100, versions[key[0]],
+                        previous["configs"].get(key[0], {}).get("compiler")))
+    print("Benchmark report written to " + BENCH_REPORT_PATH)
+    return ok
 
 
 if __name__ == "__main__":
     targets = sys.argv[1:]
 
+    if 2 == len(targets) and targets[0] in ["export-bundle", "import-bundle"]:
+        # Move the sources to a node without network through a directory of bundles
+        ok = export_bundle(targets[1]) if "export-bundle" == targets[0] else import_bundle(targets[1])
+        sys.exit(0 if ok else 1)
+
+    if 4 == len(targets) and "make-delta" == targets[0]:
+        # Difference between two prefixes (or cached archives), to update
+        # installed toolchains without copying all of them
+        sys.exit(0 if make_delta(targets[1], targets[2], targets[3]) else 1)
+
+    if 3 == len(targets) and "apply-delta" == targets[0]:
+        sys.exit(0 if apply_delta(targets[1], targets[2]) else 1)
+
+    targets = parse_options(targets)
+    if targets is None:
+        sys.exit(1)
+
+    if targets and "llvm-bench" == targets[0]:
+        # Build the LLVM profiles one after the other and compare them with
+        # the first one, "default" unless given
+        names = [n for n in targets[1:] if n in LLVM_PROFILES] or ["default", "fast", "debug"]
+        if not checkout_llvm() or not benchmark_llvm(names):
+            sys.exit(1)
+        sys.exit(0)
+
+    if targets and "slim" == targets[0]:
+        # Strip and hardlink the installed prefixes, all of them unless given
+        names = [tg for tg in installed_targets() if tg in targets[1:]] or installed_targets()
+        sys.exit(0 if slim_prefixes(names, compile_jobs()) else 1)
+
+    if targets and "bench" == targets[0]:
+        # Measure the code generated by the installed toolchains
+        names = [n for n in targets[1:] if n in BENCH_CONFIGS] or list(BENCH_CONFIGS)
+        sys.exit(0 if benchmark_toolchains(names) else 1)
+
     if 1 == len(targets) and "auto" == targets[0]:
-        # Re-clone and install all tools without interruption
-        clone_llvm_repo(auto=True)
-        build_llvm()
-        clone_riscv_repos(auto=True)
-        build_riscv64_tools(["elf", "elf-rvv", "linux", "linux-rvv"])
+        # Clone or update and install all tools without interruption, LLVM and the
+        # GNU targets are scheduled side by side
+        if BUILD_HOSTS:
+            ok = run_stages(remote_stages(GNU_TARGETS + ["llvm"]))
+        else:
+            ok = run_stages(llvm_stages(clone=True) + gnu_stages(GNU_TARGETS, clone=True))
+        if not ok:
+            sys.exit(1)
         print("Finished! You can find the installation for LLVM tools in llvm-project/install and RISC-V utils in riscv_install.")
         sys.exit(0)
 
     if 1 == len(targets) and "all" == targets[0]:
         # Install all tools bootstrap
-        valid_rv_targets = ["elf", "elf-rvv", "linux", "linux-rvv", "llvm"]
+        valid_rv_targets = GNU_TARGETS + ["llvm"]
     else:
-        # Install specific targets
-        valid_rv_targets = [v_t for v_t in targets if v_t in [
-            "elf", "elf-rvv", "linux", "linux-rvv", "llvm"]]
+        # Install specific targets, rv32 ones (rv32-elf, ...) can be mixed in
+        # and share the clones, spike and LLVM with the rv64 ones
+        valid_rv_targets = [v_t for v_t in targets if v_t in list(TARGET_MATRIX) + ["llvm"]]
 
     if valid_rv_targets:
         # Automatically install riscv-gnu-toolchain, riscv-isa-sim (spike), riscv-pk without interruption, BUT all things will be reconstructed.
+        stages = []
+        if BUILD_HOSTS:
+            # Built on the build hosts and copied back
+            stages = remote_stages(valid_rv_targets)
         if "llvm" in valid_rv_targets:
-            # Clone repo
-            clone_llvm_repo()
-            build_llvm()
+            if not BUILD_HOSTS:
+                stages += llvm_stages(ask_clone("Clone or update llvm-project repo? (y/[N]) >>> "))
             valid_rv_targets.remove("llvm")
-        if valid_rv_targets:
-            # if targets and targets[0] in ["elf", "elf-rvv", "linux", "linux-rvv"]:
+        if valid_rv_targets and not BUILD_HOSTS:
             # targets only contain riscv utils
-            clone_riscv_repos()
-            build_riscv64_tools(valid_rv_targets)
+            stages += gnu_stages(valid_rv_targets, ask_clone(
+                "Clone or update riscv-gnu-toolchain, riscv-isa-sim (spike), riscv-pk? (y/[N]) >>> "))
+        if not run_stages(stages):
+            sys.exit(1)
     else:
         opt_build_target = input("""Choose the building targets: (1/2/3/4)
 1. LLVM latest
@@ -304,29 +2925,23 @@ if __name__ == "__main__":
         if "1" == opt_build_target:
             # Clone repo
             clone_llvm_repo()
-            build_llvm()
+            run_stages(llvm_stages())
         elif opt_build_target in ["2", "3", "4", "5"]:
             # Clone repos
-            #opt_clone_repo = input(
-            #    "Re-clone riscv-gnu-toolchain, riscv-isa-sim (spike), riscv-pk? (y/[N]) >>> "
-            #)
-            #if opt_clone_repo in ['y', 'Y']:
             clone_riscv_repos()
-            #else:
-            #    print("Skip cloning repos...")
 
             opt_build = input(
                 "Start to build? (y/[N]) >>> "
             )
             if opt_build in ['y', 'Y']:
                 if "2" == opt_build_target:
-                    build_riscv64_tools(["linux"])
+                    build_gnu_tools(["linux"])
                 elif "3" == opt_build_target:
-                    build_riscv64_tools(["linux-rvv"])
+                    build_gnu_tools(["linux-rvv"])
                 elif "4" == opt_build_target:
-                    build_riscv64_tools(["elf"])
+                    build_gnu_tools(["elf"])
                 elif "5" == opt_build_target:
-                    build_riscv64_tools(["elf-rvv"])
+                    build_gnu_tools(["elf-rvv"])
             else:
                 print("Skip building...")
 
@@ -335,6 +2950,7 @@ if __name__ == "__main__":
             sys.exit(1)
 
     if valid_rv_targets:
-        print("Script finished! You can find the installation for RISC-V tools in " + RISCV_INSTALL)
+        print("Script finished! You can find the installation for RISC-V tools in " +
+              " and ".join(sorted(set(os.path.dirname(target_prefix(tg)) for tg in valid_rv_targets))))
     if "llvm" in targets:
         print("You can find the installation for LLVM tools in llvm-project/install")
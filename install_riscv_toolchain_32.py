@@ -65,198 +65,47 @@ Example:
     `python3 install_riscv_toolchain.py elf elf-rvv`
 
     This will automatically install `spike`, `pk`, `riscv32-unknown-elf`-toolchain and `riscv32-unknown-elf`-toolchain(with rvv) in `./riscv_install_32/{elf, elf-rvv}`.
+    The targets are `rv32-elf`, `rv32-elf-rvv` and `rv32-linux` of the target matrix in `install_riscv_toolchain.py`,
+    which also takes them next to the 64-bit ones (`python3 install_riscv_toolchain.py elf rv32-elf llvm`) and then
+    builds the shared sources, pk and LLVM only once.
+    `RISCV_BUILD_HOSTS=local:/tmp/h1,user@host:/build python3 install_riscv_toolchain_32.py elf linux`
+
+    This builds the targets on the listed hosts (see `install_riscv_toolchain.py`) and copies them back.
 Options in the script:
-    * RISCV_INSTALL, the installation path
-    * NUM_CORES, the number of cores for your CPU
-    * *_REPO urls, in case you have unlimited github access
-    * LLVM_BUILD_TOOL and LLVM_BUILD_BIN, if no ninja is installed
+    * All options (RISCV_INSTALL_32, NUM_CORES, *_REPO urls, DOT_GITMODULES_32, ...) are set in `install_riscv_toolchain.py`
 ISSUES:
     * The modules failed to update in riscv-gnu-toolchain
         * Remove the whole repo and re-clone may be fast
 License: GPLv3
 Copyright (c) 2022 by https://xlindo.com, All Rights Reserved.
 '''
-from multiprocessing import Pool
-import os
 import sys
 
-RISCV_INSTALL = os.getcwd() + "/riscv_install_32"
-NUM_CORES = "48"
-LLVM_BUILD_TOOL = "Ninja"
-LLVM_BUILD_BIN = "ninja"
-#LLVM_BUILD_TOOL = "Unix Makefiles"
-#LLVM_BUILD_BIN = "make"
-
-LLVM_REPO = "https://github.91chi.fun/https://github.com/llvm/llvm-project"
-
-RISCV_GNU_TOOLCHAIN_REPO = "https://github.91chi.fun/https://github.com/riscv/riscv-gnu-toolchain"
-RISCV_PK_REPO = "https://github.91chi.fun/https://github.com/riscv-software-src/riscv-pk.git"
-RISCV_SPIKE_REPO = "https://github.91chi.fun/https://github.com/riscv-software-src/riscv-isa-sim"
-RISCV_REPOS = [RISCV_GNU_TOOLCHAIN_REPO, RISCV_PK_REPO, RISCV_SPIKE_REPO]
-
-DOT_GITMODULES = r"""[submodule "riscv-binutils"]
-	path = riscv-binutils
-	url = https://github.91chi.fun/https://github.com/riscv-collab/riscv-binutils-gdb.git
-	branch = riscv-binutils-2.38
-[submodule "riscv-gcc"]
-	path = riscv-gcc
-	url = https://github.91chi.fun/https://github.com/riscv-collab/riscv-gcc.git
-	branch = riscv-gcc-12.1.0
-[submodule "glibc"]
-	path = glibc
-	url = https://gitee.com/mirrors_community_sourceware/glibc.git
-[submodule "riscv-dejagnu"]
-	path = riscv-dejagnu
-	url = https://github.91chi.fun/https://github.com/riscv-collab/riscv-dejagnu.git
-	branch = riscv-dejagnu-1.6
-[submodule "newlib"]
-	path = newlib
-	url = https://gitee.com/mirrors_community_sourceware/newlib-cygwin_1.git
-	branch = master
-[submodule "riscv-gdb"]
-	path = riscv-gdb
-	url = https://github.91chi.fun/https://github.com/riscv-collab/riscv-binutils-gdb.git
-	branch = fsf-gdb-10.1-with-sim
-[submodule "musl"]
-	path = musl
-	url = https://gitee.com/mirrors_community_musl-libc/musl.git
-	branch = master
-"""
-
-ENV_PATH = os.getenv("PATH")
-
-
-def clone_repo(repo):
-    print(repo + " cloning")
-    os.system("git clone " + repo)
-
-
-def clone_riscv_repos(auto=False):
-    opt_clone_repo = 'N'
-    if not auto:
-        opt_clone_repo = input(
-            "Re-clone riscv-gnu-toolchain, riscv-isa-sim (spike), riscv-pk? (y/[N]) >>> "
-        )
-    else:
-        opt_clone_repo = 'y'
+# The 32-bit targets are part of the target matrix of the 64-bit script, which
+# plans, clones and builds them
+import install_riscv_toolchain as rv64
 
-    if opt_clone_repo in ['y', 'Y']:
-        if os.path.exists("riscv-gnu-toolchain"):
-            os.system("rm -rf riscv-gnu-toolchain")
-        if os.path.exists("riscv-pk"):
-            os.system("rm -rf riscv-pk")
-        if os.path.exists("riscv-isa-sim"):
-            os.system("rm -rf riscv-isa-sim")
-
-        with Pool(len(RISCV_REPOS)) as pl:
-            pl.map(clone_repo, RISCV_REPOS)
-
-        update_gitmodules()
-    else:
-        print("Skip cloning repos...")
-
-
-def remkdir_cd_build():
-    if os.path.exists("build"):
-        os.system("rm -rf build")
-    os.mkdir("build")
-    os.chdir("build")
-
-
-def update_gitmodules():
-    os.chdir("riscv-gnu-toolchain")
-    os.system("git rm qemu")
-    os.system("rm -rf .gitmodules")
-    with open(".gitmodules", "w") as f:
-        f.write(DOT_GITMODULES)
-    os.system("git submodule update --init --recursive")
-    os.chdir("..")
-
-
-def build_riscv32_tools(targets):
-    if not targets:
-        return
-
-    for tg in targets:
-        INSTALL_PATH = RISCV_INSTALL + '/' + tg
-        if "elf" == tg:
-            GCC_BRANCH = "cd riscv-gcc && git reset --hard origin/riscv-gcc-12.1.0 && cd .."
-            TOOLCHAIN_CONFIG_CMD = "../configure --with-arch=rv32gc --with-abi=ilp32d --prefix=" + INSTALL_PATH
-            TOOLCHAIN_MAKE_CMD = "make -j" + NUM_CORES
-            PK_CONFIG_CMD = "../configure --host=riscv32-unknown-elf CC=riscv32-unknown-elf-gcc --with-arch=rv32gc --prefix="+INSTALL_PATH
-        elif "elf-rvv" == tg:
-            GCC_BRANCH = "cd riscv-gcc && git reset --hard origin/riscv-gcc-rvv-next && cd .."
-            TOOLCHAIN_CONFIG_CMD = "../configure --with-arch=rv32gcv --with-abi=ilp32d --prefix=" + INSTALL_PATH
-            TOOLCHAIN_MAKE_CMD = "make -j" + NUM_CORES
-            PK_CONFIG_CMD = "../configure --host=riscv32-unknown-elf CC=riscv32-unknown-elf-gcc --prefix="+INSTALL_PATH
-        elif "linux" == tg:
-            GCC_BRANCH = "cd riscv-gcc && git reset --hard origin/riscv-gcc-12.1.0 && cd .."
-            TOOLCHAIN_CONFIG_CMD = "../configure --with-arch=rv32gc --with-abi=ilp32d --prefix=" + INSTALL_PATH
-            TOOLCHAIN_MAKE_CMD = "make linux -j" + NUM_CORES
-            PK_CONFIG_CMD = "../configure --host=riscv32-unknown-linux-gnu CC=riscv32-unknown-linux-gnu-gcc --prefix="+INSTALL_PATH
-        else:
-            print("Invalid target!")
-            continue
-
-        if os.path.exists(INSTALL_PATH):
-            os.system("rm -rf " + INSTALL_PATH)
-        # install riscv-gnu-toolchain
-        os.chdir("riscv-gnu-toolchain")
-        os.system(GCC_BRANCH)
-        remkdir_cd_build()
-        os.system(TOOLCHAIN_CONFIG_CMD)
-        os.system(TOOLCHAIN_MAKE_CMD)
-        os.chdir("../..")
-
-        # install riscv-pk
-        os.chdir("riscv-pk")
-        remkdir_cd_build()
-        os.environ["PATH"] = INSTALL_PATH + "/bin:" + ENV_PATH
-        os.system(PK_CONFIG_CMD)
-        os.system("make -j48 && make install")
-        os.chdir("../..")
-
-        # install riscv-isa-sim (spike)
-        os.chdir("riscv-isa-sim")
-        remkdir_cd_build()
-        os.system("../configure --prefix=" + INSTALL_PATH)
-        os.system("make -j48 && make install")
-        os.chdir("../..")
-
-
-def clone_llvm_repo(auto=False):
-    opt_clone_repo = 'N'
-    if not auto:
-        opt_clone_repo = input("Re-clone llvm-project repo? (y/[N]) >>> ")
-    else:
-        opt_clone_repo = 'y'
-
-    if opt_clone_repo in ['y', 'Y']:
-        if os.path.exists("llvm-project"):
-            os.system("rm -rf llvm-project")
-        os.system("git clone " + LLVM_REPO)
-    else:
-        print("Skip cloning llvm-project...")
-
-
-def build_llvm():
-    os.chdir("llvm-project")
-    remkdir_cd_build()
-
-    os.system('cmake -G "' + LLVM_BUILD_TOOL + '" -DCMAKE_C_COMPILER=`which gcc` -DCMAKE_CXX_COMPILER=`which g++` -DCMAKE_ASM_COMPILER=`which gcc` -DCMAKE_BUILD_TYPE=Release -DCMAKE_INSTALL_PREFIX=../install -DLLVM_TARGETS_TO_BUILD="RISCV" -DLLVM_ENABLE_PROJECTS="clang" ../llvm')
-    os.system(LLVM_BUILD_BIN + " -j" + NUM_CORES +
-              " && " + LLVM_BUILD_BIN + " install")
+RISCV_INSTALL = rv64.RISCV_INSTALL_32
+TARGETS = {"elf": "rv32-elf", "elf-rvv": "rv32-elf-rvv", "linux": "rv32-linux"}
 
 
 if __name__ == "__main__":
     targets = sys.argv[1:]
 
+    targets = rv64.parse_options(targets)
+    if targets is None:
+        sys.exit(1)
+    if rv64.BRANCH:
+        RISCV_INSTALL += "@" + rv64.BRANCH.replace("/", "_")
+
     if 1 == len(targets) and "auto" == targets[0]:
-        # Re-clone and install all tools without interruption
-        clone_llvm_repo(auto=True)
-        build_llvm()
-        clone_riscv_repos(auto=True)
-        build_riscv32_tools(["elf", "elf-rvv", "linux"])
+        # Clone or update and install all tools without interruption
+        if rv64.BUILD_HOSTS:
+            ok = rv64.run_stages(rv64.remote_stages(rv64.RV32_TARGETS + ["llvm"]))
+        else:
+            ok = rv64.run_stages(rv64.llvm_stages(clone=True) + rv64.gnu_stages(rv64.RV32_TARGETS, clone=True))
+        if not ok:
+            sys.exit(1)
         print("Finished! You can find the installation for LLVM tools in llvm-project/install and RISC-V utils in riscv_install_32.")
         sys.exit(0)
 
@@ -269,17 +118,20 @@ if __name__ == "__main__":
             "elf", "elf-rvv", "linux", "llvm"]]
 
     if valid_rv_targets:
-        # Automatically install riscv-gnu-toolchain, riscv-isa-sim (spike), riscv-pk without interruption, BUT all things will be reconstructed.
+        stages = []
+        if rv64.BUILD_HOSTS:
+            # Built on the build hosts and copied back
+            stages = rv64.remote_stages([TARGETS.get(tg, tg) for tg in valid_rv_targets])
         if "llvm" in valid_rv_targets:
-            # Clone repo
-            clone_llvm_repo()
-            build_llvm()
+            if not rv64.BUILD_HOSTS:
+                stages += rv64.llvm_stages(rv64.ask_clone("Clone or update llvm-project repo? (y/[N]) >>> "))
             valid_rv_targets.remove("llvm")
-        if valid_rv_targets:
-            # if targets and targets[0] in ["elf", "elf-rvv", "linux"]:
+        if valid_rv_targets and not rv64.BUILD_HOSTS:
             # targets only contain riscv utils
-            clone_riscv_repos()
-            build_riscv32_tools(valid_rv_targets)
+            stages += rv64.gnu_stages([TARGETS[tg] for tg in valid_rv_targets], rv64.ask_clone(
+                "Clone or update riscv-gnu-toolchain, riscv-isa-sim (spike), riscv-pk? (y/[N]) >>> "))
+        if not rv64.run_stages(stages):
+            sys.exit(1)
     else:
         opt_build_target = input("""Choose the building targets: (1/2/3/4)
 1. riscv32-linux-unknown-gnu, spike and pk
@@ -291,24 +143,18 @@ if __name__ == "__main__":
 
         if "4" == opt_build_target:
             # Clone repo
-            clone_llvm_repo()
-            build_llvm()
+            rv64.clone_llvm_repo()
+            rv64.run_stages(rv64.llvm_stages())
         elif opt_build_target in ["1", "2", "3"]:
             # Clone repos
-            opt_clone_repo = input(
-                "Re-clone riscv-gnu-toolchain, riscv-isa-sim (spike), riscv-pk? (y/[N]) >>> "
-            )
-            if opt_clone_repo in ['y', 'Y']:
-                clone_riscv_repos()
-            else:
-                print("Skip cloning repos...")
+            rv64.clone_riscv_repos()
 
             if "1" == opt_build_target:
-                build_riscv32_tools(["linux"])
+                rv64.build_gnu_tools(["rv32-linux"])
             elif "2" == opt_build_target:
-                build_riscv32_tools(["elf"])
+                rv64.build_gnu_tools(["rv32-elf"])
             elif "3" == opt_build_target:
-                build_riscv32_tools(["elf-rvv"])
+                rv64.build_gnu_tools(["rv32-elf-rvv"])
 
         else:
             print("Invalid input...quit...")
@@ -0,0 +1,396 @@
+#!/usr/bin/python3
+#
+'''
+Description: A long-running build service for the RISC-V toolchains
+    * Takes build requests (targets, riscv-gnu-toolchain branch, flags) over HTTP or a Unix socket and queues them
+    * A request identical to a queued one is merged into it, every requester gets the result of that build
+    * Builds run one after the other with `install_riscv_toolchain.py --yes` in one work directory, so the clones,
+      worktrees, build trees, mirrors and caches of earlier builds are reused. Queued builds with the same branch
+      and flags run together in one invocation and share its clones, spike, pk and LLVM
+    * The queue and the finished builds are kept in `build_service.json`, a restarted service runs the builds
+      that were queued or running again
+Usage:
+    * `python3 riscv_build_service.py [config.toml|config.json]`
+    * `curl -d '{"targets": ["elf"], "flags": {"profile": "ci"}}' http://127.0.0.1:8642/builds`
+    * `curl 'http://127.0.0.1:8642/builds/1?wait=3600'`
+    * `curl --unix-socket /run/riscv/build.sock http://localhost/builds` with `listen = "unix:/run/riscv/build.sock"`
+API (JSON):
+    * POST /builds {"targets": [...], "branch": "...", "flags": {...}}, 202 with the build, "merged" when an
+      identical queued build was reused. Targets are those of TARGET_MATRIX and "llvm", the branch is empty for
+      the branches of TOOLCHAIN_SOURCES, the flags are "profile", "llvm_profile", "multilib", "offline" and "slim"
+    * GET /builds, all builds; GET /builds/<id>, one build, `?wait=<seconds>` returns once it finished
+    * GET /builds/<id>/log and GET /builds/<id>/report, the output and `build_report.json` of its run
+    * DELETE /builds/<id>, drops one requester of a queued build, it is cancelled when none is left
+    * GET /status, the queue and the running builds
+Options in the config (CONFIG):
+    * listen, "host:port" or "unix:<path>"
+    * work_dir, where the builds run and install
+    * env, environment of every build ({"RISCV_NUM_CORES": "32", "RISCV_MIRROR_DIR": "/srv/mirrors", ...})
+    * flags, the flags of requests that do not set them
+    * history and max_wait, finished builds kept and the longest wait of a request
+License: GPLv3
+Copyright (c) 2022 by https://xlindo.com, All Rights Reserved.
+'''
+import json
+import os
+import re
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# TOML configs need Python 3.11, JSON ones work from Python 3.6 on
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+# Targets, profiles and the journal format come from the install script
+import install_riscv_toolchain as rv64
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "install_riscv_toolchain.py")
+CONFIG = {
+    "listen": "127.0.0.1:8642",
+    "work_dir": os.getcwd(),
+    "env": {},
+    "flags": {"profile": rv64.BUILD_PROFILE, "llvm_profile": rv64.LLVM_PROFILE, "multilib": rv64.MULTILIB,
+              "offline": rv64.OFFLINE, "slim": rv64.SLIM_AFTER_BUILD},
+    "history": 200,
+    "max_wait": 3600,
+}
+STATE_NAME = "build_service.json"
+RUN_LOG_DIR = "service_logs"
+BRANCH_PATTERN = re.compile(r"^[A-Za-z0-9._][A-Za-z0-9._/-]*$")
+
+# Builds by id, the ids of the queued ones oldest first. STATE_LOCK guards
+# both and is notified whenever a build changes.
+BUILDS = {}
+QUEUE = []
+STATE_LOCK = threading.Condition()
+NEXT_ID = [1]
+
+
+def load_config(path):
+    if path.endswith(".toml"):
+        if tomllib is None:
+            print("TOML configs need Python 3.11 (tomllib), use a JSON one")
+            return False
+        with open(path, "rb") as f:
+            config = tomllib.load(f)
+    else:
+        with open(path) as f:
+            config = json.load(f)
+    unknown = [k for k in config if k not in CONFIG] + \
+        ["flags." + k for k in config.get("flags", {}) if k not in CONFIG["flags"]]
+    if unknown:
+        print("Unknown config options! " + " ".join(unknown))
+        return False
+    for key, value in config.items():
+        if key in ["env", "flags"]:
+            CONFIG[key].update(value)
+        else:
+            CONFIG[key] = value
+    CONFIG["env"] = dict((k, str(v)) for k, v in CONFIG["env"].items())
+    CONFIG["work_dir"] = os.path.abspath(CONFIG["work_dir"])
+    return True
+
+
+def check_request(req):
+    # (targets, branch, flags) of a request body, or an error message
+    if not isinstance(req, dict):
+        return "the request is not an object"
+    targets = req.get("targets", req.get("target"))
+    targets = [targets] if isinstance(targets, str) else targets
+    valid = list(rv64.TARGET_MATRIX) + ["llvm"]
+    if not targets or not isinstance(targets, list) or [tg for tg in targets if tg not in valid]:
+        return "targets must be some of " + " ".join(valid)
+    branch = req.get("branch") or ""
+    if not isinstance(branch, str) or (branch and not BRANCH_PATTERN.match(branch)):
+        return "invalid branch"
+    flags = req.get("flags") or {}
+    if not isinstance(flags, dict) or [k for k in flags if k not in CONFIG["flags"]]:
+        return "flags must be some of " + " ".join(CONFIG["flags"])
+    flags = dict(CONFIG["flags"], **flags)
+    if flags["profile"] not in rv64.BUILD_PROFILES:
+        return "profile must be one of " + " ".join(rv64.BUILD_PROFILES)
+    if flags["llvm_profile"] not in rv64.LLVM_PROFILES:
+        return "llvm_profile must be one of " + " ".join(rv64.LLVM_PROFILES)
+    if [k for k in ["multilib", "offline", "slim"] if not isinstance(flags[k], bool)]:
+        return "multilib, offline and slim must be true or false"
+    return sorted(set(targets)), branch, flags
+
+
+def run_key(build):
+    # Builds with the same key can run in one invocation
+    return json.dumps([build["branch"], build["flags"]], sort_keys=True)
+
+
+def request_key(targets, branch, flags):
+    return json.dumps([sorted(targets), branch, flags], sort_keys=True)
+
+
+def save_state():
+    # Called with STATE_LOCK held
+    finished = [b for b in BUILDS.values() if b["status"] in ["done", "failed", "cancelled"]]
+    for b in sorted(finished, key=lambda b: b["finished"])[:max(0, len(finished) - CONFIG["history"])]:
+        del BUILDS[b["id"]]
+    path = os.path.join(CONFIG["work_dir"], STATE_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"next_id": NEXT_ID[0], "builds": list(BUILDS.values())}, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def load_state():
+    # Builds interrupted by a restart are queued again
+    try:
+        with open(os.path.join(CONFIG["work_dir"], STATE_NAME)) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return
+    NEXT_ID[0] = state["next_id"]
+    for b in state["builds"]:
+        if "running" == b["status"]:
+            b.update(status="queued", started=None, run=None)
+        BUILDS[b["id"]] = b
+    QUEUE.extend(sorted((b["id"] for b in BUILDS.values() if "queued" == b["status"]), key=int))
+    if QUEUE:
+        print("[service] " + str(len(QUEUE)) + " builds queued again")
+
+
+def submit(req):
+    # (build, merged) for a checked request, an identical queued build takes
+    # one more requester instead of a new build
+    targets, branch, flags = req
+    key = request_key(targets, branch, flags)
+    with STATE_LOCK:
+        for bid in QUEUE:
+            if key == BUILDS[bid]["key"]:
+                BUILDS[bid]["requesters"] += 1
+                save_state()
+                return dict(BUILDS[bid]), True
+        bid = str(NEXT_ID[0])
+        NEXT_ID[0] += 1
+        BUILDS[bid] = {"id": bid, "key": key, "targets": targets, "branch": branch, "flags": flags,
+                       "status": "queued", "requesters": 1, "queued": time.time(), "started": None,
+                       "finished": None, "run": None, "prefixes": {}, "failed": []}
+        QUEUE.append(bid)
+        save_state()
+        STATE_LOCK.notify_all()
+        return dict(BUILDS[bid]), False
+
+
+def cancel(bid):
+    with STATE_LOCK:
+        build = BUILDS.get(bid)
+        if not build or "queued" != build["status"]:
+            return build
+        build["requesters"] -= 1
+        if 0 == build["requesters"]:
+            QUEUE.remove(bid)
+            build.update(status="cancelled", finished=time.time())
+        save_state()
+        STATE_LOCK.notify_all()
+        return dict(build)
+
+
+def wait_build(bid, seconds):
+    with STATE_LOCK:
+        STATE_LOCK.wait_for(lambda: BUILDS.get(bid, {}).get("status") not in ["queued", "running"],
+                            timeout=min(seconds, CONFIG["max_wait"]))
+        return dict(BUILDS[bid]) if bid in BUILDS else None
+
+
+def next_batch():
+    # The oldest queued build and the other queued builds running with the
+    # same branch and flags
+    with STATE_LOCK:
+        STATE_LOCK.wait_for(lambda: QUEUE)
+        key = run_key(BUILDS[QUEUE[0]])
+        batch = [BUILDS[bid] for bid in QUEUE if key == run_key(BUILDS[bid])]
+        run_id = batch[0]["id"]
+        for build in batch:
+            QUEUE.remove(build["id"])
+            build.update(status="running", started=time.time(), run=run_id)
+        save_state()
+        STATE_LOCK.notify_all()
+        return run_id, [dict(b) for b in batch]
+
+
+def build_argv(targets, branch, flags):
+    argv = ["--yes", "--profile=" + flags["profile"]]
+    if branch:
+        argv.append("--branch=" + branch)
+    if flags["multilib"]:
+        argv.append("--multilib")
+    if flags["offline"]:
+        argv.append("--offline")
+    return argv + targets
+
+
+def installed_prefix(tg, branch):
+    # Where the install script puts tg when it runs in the work directory
+    if "llvm" == tg:
+        return os.path.join(CONFIG["work_dir"], "llvm-project", "install")
+    root, name = os.path.split(os.path.relpath(rv64.target_prefix(tg), rv64.WORK_DIR))
+    if branch:
+        root += "@" + branch.replace("/", "_")
+    return os.path.join(CONFIG["work_dir"], root, name)
+
+
+def completed_targets(argv, targets):
+    # Targets whose stages all completed in the run of argv, from its journal
+    try:
+        with open(os.path.join(CONFIG["work_dir"], os.path.basename(rv64.JOURNAL_PATH))) as f:
+            journal = json.load(f)
+    except (OSError, ValueError):
+        return []
+    if journal.get("argv") != argv:
+        return []
+    return [tg for tg in targets if "done" == journal["stages"].get("pack-" + tg)]
+
+
+def run_batch(run_id, batch):
+    targets = sorted(set(tg for build in batch for tg in build["targets"]))
+    branch, flags = batch[0]["branch"], batch[0]["flags"]
+    argv = build_argv(targets, branch, flags)
+    env = dict(os.environ, **CONFIG["env"])
+    env.update(RISCV_LLVM_PROFILE=flags["llvm_profile"], RISCV_SLIM="1" if flags["slim"] else "0")
+    log_dir = os.path.join(CONFIG["work_dir"], RUN_LOG_DIR)
+    os.makedirs(log_dir, exist_ok=True)
+    print("[service] run " + run_id + ": builds " + " ".join(b["id"] for b in batch) + ", " + " ".join(argv))
+    start = time.time()
+    with open(os.path.join(log_dir, "run-" + run_id + ".log"), "w") as log:
+        res = subprocess.run([sys.executable, SCRIPT] + argv, cwd=CONFIG["work_dir"], env=env,
+                             stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+    done = targets if 0 == res.returncode else completed_targets(argv, targets)
+    report = os.path.join(CONFIG["work_dir"], os.path.basename(rv64.REPORT_PATH))
+    if os.path.exists(report) and os.path.getmtime(report) >= start:
+        os.replace(report, os.path.join(log_dir, "run-" + run_id + ".json"))
+    print("[service] run " + run_id + " finished in " + rv64.fmt_time(time.time() - start) +
+          (", failed: " + " ".join(tg for tg in targets if tg not in done) if len(done) < len(targets) else ""))
+    with STATE_LOCK:
+        for b in batch:
+            failed = [tg for tg in b["targets"] if tg not in done]
+            BUILDS[b["id"]].update(status="failed" if failed else "done", finished=time.time(), failed=failed,
+                                   prefixes=dict((tg, installed_prefix(tg, branch)) for tg in b["targets"]
+                                                 if tg not in failed))
+        save_state()
+        STATE_LOCK.notify_all()
+
+
+def worker():
+    # One run at a time, they share the work directory
+    while True:
+        run_batch(*next_batch())
+
+
+def run_file(bid, ext):
+    with STATE_LOCK:
+        run_id = BUILDS.get(bid, {}).get("run")
+    path = os.path.join(CONFIG["work_dir"], RUN_LOG_DIR, "run-" + str(run_id) + ext)
+    return path if run_id and os.path.exists(path) else None
+
+
+class Handler(BaseHTTPRequestHandler):
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def reply(self, code, body, content_type="application/json"):
+        data = body if isinstance(body, bytes) else (json.dumps(body, indent=1) + "\n").encode()
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self):
+        url = urlparse(self.path)
+        return [p for p in url.path.split("/") if p], parse_qs(url.query)
+
+    def do_GET(self):
+        parts, query = self.route()
+        if ["status"] == parts:
+            with STATE_LOCK:
+                running = [b["id"] for b in BUILDS.values() if "running" == b["status"]]
+                self.reply(200, {"queue": list(QUEUE), "running": running, "builds": len(BUILDS)})
+        elif ["builds"] == parts:
+            with STATE_LOCK:
+                self.reply(200, sorted(BUILDS.values(), key=lambda b: int(b["id"])))
+        elif 2 == len(parts) and "builds" == parts[0]:
+            try:
+                build = wait_build(parts[1], float(query.get("wait", ["0"])[0]))
+            except ValueError:
+                return self.reply(400, {"error": "wait must be a number of seconds"})
+            if not build:
+                return self.reply(404, {"error": "no build " + parts[1]})
+            self.reply(200, build)
+        elif 3 == len(parts) and "builds" == parts[0] and parts[2] in ["log", "report"]:
+            path = run_file(parts[1], ".log" if "log" == parts[2] else ".json")
+            if not path:
+                return self.reply(404, {"error": "no " + parts[2] + " for build " + parts[1]})
+            with open(path, "rb") as f:
+                self.reply(200, f.read(), "text/plain" if "log" == parts[2] else "application/json")
+        else:
+            self.reply(404, {"error": "unknown path " + self.path})
+
+    def do_POST(self):
+        parts, _ = self.route()
+        if ["builds"] != parts:
+            return self.reply(404, {"error": "unknown path " + self.path})
+        try:
+            req = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            return self.reply(400, {"error": "the request is not JSON"})
+        req = check_request(req)
+        if isinstance(req, str):
+            return self.reply(400, {"error": req})
+        build, merged = submit(req)
+        self.reply(202, dict(build, merged=merged))
+
+    def do_DELETE(self):
+        parts, _ = self.route()
+        if 2 != len(parts) or "builds" != parts[0]:
+            return self.reply(404, {"error": "unknown path " + self.path})
+        build = cancel(parts[1])
+        if not build:
+            return self.reply(404, {"error": "no build " + parts[1]})
+        self.reply(200 if build["status"] in ["queued", "cancelled"] else 409, build)
+
+
+# http.server.ThreadingHTTPServer is only there since Python 3.7
+class TCPHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(listen):
+    if listen.startswith("unix:"):
+        path = listen[len("unix:"):]
+        if os.path.exists(path):
+            os.remove(path)
+        return UnixHTTPServer(path, Handler)
+    host, port = listen.rsplit(":", 1)
+    return TCPHTTPServer((host, int(port)), Handler)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 or (2 == len(sys.argv) and not load_config(sys.argv[1])):
+        print("Usage: python3 riscv_build_service.py [config.toml|config.json]")
+        sys.exit(1)
+    os.makedirs(CONFIG["work_dir"], exist_ok=True)
+    load_state()
+    server = make_server(CONFIG["listen"])
+    threading.Thread(target=worker, daemon=True).start()
+    print("[service] listening on " + CONFIG["listen"] + ", building in " + CONFIG["work_dir"])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+'''
+Tests of the stamps, the journal, the mirror ranking and the option parsing
+of install_riscv_toolchain.py, on small local git repositories.
+    * `python3 -m unittest test_install_riscv_toolchain` or `python3 -m pytest`
+'''
+import copy
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import install_riscv_toolchain as rv64
+
+# Local file:// submodules and commits without a configured identity
+GIT_ENV = {"GIT_CONFIG_COUNT": "1", "GIT_CONFIG_KEY_0": "protocol.file.allow", "GIT_CONFIG_VALUE_0": "always",
+           "GIT_AUTHOR_NAME": "test", "GIT_AUTHOR_EMAIL": "test@localhost",
+           "GIT_COMMITTER_NAME": "test", "GIT_COMMITTER_EMAIL": "test@localhost"}
+
+
+def git(cmd, cwd):
+    subprocess.run("git " + cmd, shell=True, cwd=cwd, check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+class ScriptTest(unittest.TestCase):
+    # Runs every test in a temporary work directory and restores the
+    # settings of the script afterwards
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="riscv_test_")
+        self.saved = {}
+        self.saved_env = dict(os.environ)
+        os.environ.update(GIT_ENV)
+        self.saved_matrix = copy.deepcopy(rv64.TARGET_MATRIX)
+        self.saved_sources = copy.deepcopy(rv64.TOOLCHAIN_SOURCES)
+        self.set(WORK_DIR=self.tmp, WORKTREE_DIR=os.path.join(self.tmp, "worktrees"),
+                 JOURNAL_PATH=os.path.join(self.tmp, "build_journal.json"), STREAM_LOGS=False, USE_MIRROR=False,
+                 SCRATCH_DIR="")
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(rv64, name, value)
+        rv64.TARGET_MATRIX.clear()
+        rv64.TARGET_MATRIX.update(self.saved_matrix)
+        rv64.TOOLCHAIN_SOURCES.clear()
+        rv64.TOOLCHAIN_SOURCES.update(self.saved_sources)
+        rv64.MIRROR_RANKS.clear()
+        os.environ.clear()
+        os.environ.update(self.saved_env)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def set(self, **values):
+        for name, value in values.items():
+            self.saved.setdefault(name, getattr(rv64, name))
+            setattr(rv64, name, value)
+
+    def repo(self, name, files, branch="master"):
+        path = os.path.join(self.tmp, name)
+        os.makedirs(path)
+        git("init -q -b " + branch, path)
+        for rel, text in files.items():
+            write(os.path.join(path, rel), text)
+        git("add -A && git commit -q -m init", path)
+        return path
+
+
+class SourceRevisionsTest(ScriptTest):
+    def setUp(self):
+        super().setUp()
+        sub = self.repo("newlib", {"libc.c": "int x;\n"})
+        self.src = self.repo("top", {"Makefile": "all:\n"})
+        git("submodule add -q file://" + sub + " newlib && git commit -q -m sub", self.src)
+
+    def test_submodule_edit_only_changes_its_entry(self):
+        old = rv64.source_revisions(self.src)
+        write(os.path.join(self.src, "newlib", "libc.c"), "int y;\n")
+        new = rv64.source_revisions(self.src)
+        self.assertEqual(old["."], new["."])
+        self.assertNotEqual(old["newlib"], new["newlib"])
+
+    def test_top_level_edit_changes_the_top_level_entry(self):
+        old = rv64.source_revisions(self.src)
+        write(os.path.join(self.src, "Makefile"), "all:\n\ttrue\n")
+        new = rv64.source_revisions(self.src)
+        self.assertNotEqual(old["."], new["."])
+        self.assertEqual(old["newlib"], new["newlib"])
+
+
+class PrepareBuildTest(ScriptTest):
+    def setUp(self):
+        super().setUp()
+        self.src = self.repo("pk", {"configure": "#!/bin/sh\n"})
+        self.installed = os.path.join(self.tmp, "installed")
+
+    def stamp(self, configure):
+        return rv64.stage_stamp(self.src, configure, {})
+
+    def test_full_then_skip(self):
+        build, mode, _ = rv64.prepare_build(self.src, "build", self.stamp("../configure"), self.installed)
+        self.assertEqual("full", mode)
+        # No stamp until configure succeeded
+        self.assertIsNone(rv64.read_stamp(build))
+        rv64.write_stamp(build, self.stamp("../configure"))
+        write(self.installed, "")
+        self.assertEqual("skip", rv64.prepare_build(self.src, "build", self.stamp("../configure"), self.installed)[1])
+
+    def test_changed_sources_build_incrementally(self):
+        build = os.path.join(self.src, "build")
+        os.makedirs(build)
+        old = self.stamp("../configure")
+        rv64.write_stamp(build, dict(old, sources={".": "old", "gone": "x"}))
+        _, mode, prev = rv64.prepare_build(self.src, "build", old, self.installed)
+        self.assertEqual("incremental", mode)
+        self.assertEqual("old", prev["sources"]["."])
+        # Until make succeeds, the changed sources do not count as built
+        self.assertEqual({}, rv64.read_stamp(build)["sources"])
+
+    def test_changed_configure_builds_from_scratch(self):
+        build = os.path.join(self.src, "build")
+        write(os.path.join(build, "config.status"), "")
+        rv64.write_stamp(build, self.stamp("../configure"))
+        _, mode, _ = rv64.prepare_build(self.src, "build", self.stamp("../configure --enable-x"), self.installed)
+        self.assertEqual("full", mode)
+        self.assertFalse(os.path.exists(os.path.join(build, "config.status")))
+
+    def test_failed_configure_runs_again(self):
+        self.assertFalse(rv64.build_configured("pk", self.src, "build", "false", "true", self.installed))
+        self.assertIsNone(rv64.read_stamp(os.path.join(self.src, "build")))
+        # A later run configures again instead of running make alone
+        self.assertEqual("full", rv64.prepare_build(self.src, "build", self.stamp("false"), self.installed)[1])
+        self.assertTrue(rv64.build_configured("pk", self.src, "build", "true", "true", self.installed))
+        self.assertEqual(self.stamp("true"), rv64.read_stamp(os.path.join(self.src, "build")))
+
+
+class UpdateGitmodulesTest(ScriptTest):
+    def test_worktree_follows_the_gcc_branch(self):
+        gcc = self.repo("gcc", {"gcc.c": "1\n"}, branch="riscv-gcc-test")
+        top = self.repo("toolchain", {"Makefile": "all:\n"})
+        git("submodule add -q -b riscv-gcc-test file://" + gcc + " riscv-gcc && git commit -q -m gcc", top)
+        git("clone -q file://" + top + " riscv-gnu-toolchain", self.tmp)
+        rv64.TOOLCHAIN_SOURCES["test"] = {"branch": "master", "gitmodules": None, "gcc": "riscv-gcc-test"}
+        self.assertTrue(rv64.fetch_gitmodules())
+        self.assertTrue(rv64.update_gitmodules("test"))
+        # The worktree stays, the next run has to fetch the new gcc commit
+        write(os.path.join(gcc, "gcc.c"), "2\n")
+        git("commit -q -am 2", gcc)
+        head = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=gcc).decode().strip()
+        self.assertTrue(rv64.update_gitmodules("test"))
+        worktree = os.path.join(rv64.WORKTREE_DIR, "riscv-gnu-toolchain-test", "riscv-gcc")
+        self.assertEqual(head, rv64.cmd_output("git rev-parse HEAD", worktree))
+
+
+class RankedMirrorsTest(ScriptTest):
+    def test_ranked_by_latency_and_throughput(self):
+        url = "https://example.com/repo.git"
+        self.set(mirror_candidates=lambda u: [u, "https://slow.example.com/repo.git",
+                                              "https://down.example.com/repo.git", "https://nosample.example.com/r"])
+        latency = {url: 0.3, "https://slow.example.com/repo.git": 0.01, "https://nosample.example.com/r": 0.01}
+        # 10 MB/s behind a higher latency beats 100 KB/s
+        rate = {url: 10 * 1024 ** 2, "https://slow.example.com/repo.git": 100 * 1024}
+        self.set(probe_mirror=latency.get, sample_throughput=rate.get)
+        ranked = rv64.ranked_mirrors(url)
+        self.assertEqual([url, "https://slow.example.com/repo.git", "https://nosample.example.com/r",
+                          "https://down.example.com/repo.git"], ranked)
+        # Probed once per run
+        self.set(probe_mirror=None)
+        self.assertEqual(ranked, rv64.ranked_mirrors(url))
+
+    def test_single_candidate_is_not_probed(self):
+        self.set(MIRRORS={}, MIRROR_PREFIXES={}, probe_mirror=None)
+        self.assertEqual(["file:///repo"], rv64.ranked_mirrors("file:///repo"))
+
+
+class JournalTest(ScriptTest):
+    def stages(self):
+        return [rv64.Stage("clone-x", None), rv64.Stage("toolchain-elf", None), rv64.Stage("pk-x", None)]
+
+    def test_resume_skips_completed_stages(self):
+        journal = rv64.start_journal(self.stages())
+        journal["stages"]["clone-x"] = "done"
+        journal["stages"]["toolchain-elf"] = "failed"
+        del journal["stages"]["pk-x"]
+        journal["argv"] = ["--yes", "elf"]
+        rv64.write_journal(journal)
+        self.assertEqual(["--yes", "elf"], rv64.resume_targets())
+
+        self.set(RESUME=True)
+        stages = self.stages()
+        rv64.start_journal(stages)
+        self.assertEqual(["done", "pending", "done"], [st.status for st in stages])
+        self.assertEqual(["--yes", "elf"], rv64.read_journal()["argv"])
+
+    def test_nothing_to_resume(self):
+        self.assertIsNone(rv64.resume_targets())
+
+
+class ParseOptionsTest(ScriptTest):
+    def setUp(self):
+        super().setUp()
+        self.set(RESUME=False, OFFLINE=False, ASSUME_YES=False, MULTILIB=False, BUILD_PROFILE="full", BRANCH="")
+
+    def test_options_are_removed(self):
+        targets = rv64.parse_options(["--yes", "elf", "--multilib", "--profile=ci", "linux"])
+        self.assertEqual(["elf", "linux"], targets)
+        self.assertTrue(rv64.ASSUME_YES and rv64.MULTILIB)
+        self.assertEqual("ci", rv64.BUILD_PROFILE)
+
+    def test_branch_moves_the_prefixes(self):
+        self.assertEqual(["elf"], rv64.parse_options(["--branch=dev/x", "elf"]))
+        self.assertEqual("riscv_install@dev_x", os.path.basename(os.path.dirname(rv64.target_prefix("elf"))))
+
+    def test_invalid_profile(self):
+        self.assertIsNone(rv64.parse_options(["--profile=nope", "elf"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
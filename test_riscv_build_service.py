@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+'''
+Tests of the request checking, merging and batching of riscv_build_service.py.
+    * `python3 -m unittest test_riscv_build_service` or `python3 -m pytest`
+'''
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import riscv_build_service as service
+
+
+class ServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="riscv_service_test_")
+        self.saved_work_dir = service.CONFIG["work_dir"]
+        service.CONFIG["work_dir"] = self.tmp
+        service.BUILDS.clear()
+        del service.QUEUE[:]
+        service.NEXT_ID[0] = 1
+
+    def tearDown(self):
+        service.CONFIG["work_dir"] = self.saved_work_dir
+        service.BUILDS.clear()
+        del service.QUEUE[:]
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def submit(self, body):
+        req = service.check_request(body)
+        self.assertIsInstance(req, tuple, req)
+        return service.submit(req)
+
+    def test_check_request(self):
+        self.assertEqual("targets must be some of", service.check_request({"targets": ["nope"]})[:23])
+        self.assertEqual("invalid branch", service.check_request({"targets": ["elf"], "branch": "-x"}))
+        self.assertIn("flags must be", service.check_request({"targets": ["elf"], "flags": {"jobs": 1}}))
+        targets, branch, flags = service.check_request({"target": "elf", "flags": {"profile": "ci"}})
+        self.assertEqual((["elf"], "", "ci"), (targets, branch, flags["profile"]))
+
+    def test_identical_requests_merge(self):
+        first, merged = self.submit({"targets": ["elf", "linux"]})
+        self.assertFalse(merged)
+        again, merged = self.submit({"targets": ["linux", "elf"]})
+        self.assertTrue(merged)
+        self.assertEqual(first["id"], again["id"])
+        self.assertEqual(2, service.BUILDS[first["id"]]["requesters"])
+        other, merged = self.submit({"targets": ["elf", "linux"], "flags": {"profile": "ci"}})
+        self.assertFalse(merged)
+        self.assertNotEqual(first["id"], other["id"])
+        with open(os.path.join(self.tmp, service.STATE_NAME)) as f:
+            self.assertEqual(2, len(json.load(f)["builds"]))
+
+    def test_cancel_drops_one_requester(self):
+        build, _ = self.submit({"targets": ["elf"]})
+        self.submit({"targets": ["elf"]})
+        self.assertEqual("queued", service.cancel(build["id"])["status"])
+        self.assertEqual("cancelled", service.cancel(build["id"])["status"])
+        self.assertEqual([], service.QUEUE)
+
+    def test_batch_takes_builds_with_the_same_branch_and_flags(self):
+        a, _ = self.submit({"targets": ["elf"]})
+        b, _ = self.submit({"targets": ["elf"], "branch": "dev"})
+        c, _ = self.submit({"targets": ["linux"]})
+        run_id, batch = service.next_batch()
+        self.assertEqual(a["id"], run_id)
+        self.assertEqual([a["id"], c["id"]], [build["id"] for build in batch])
+        self.assertEqual([b["id"]], service.QUEUE)
+        self.assertEqual("running", service.BUILDS[c["id"]]["status"])
+
+    def test_build_argv(self):
+        flags = dict(service.CONFIG["flags"], profile="ci", multilib=True, offline=False)
+        self.assertEqual(["--yes", "--profile=ci", "--branch=dev", "--multilib", "elf"],
+                         service.build_argv(["elf"], "dev", flags))
+
+
+if __name__ == "__main__":
+    unittest.main()